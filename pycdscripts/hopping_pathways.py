@@ -2,16 +2,45 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from fractions import gcd
+from multiprocessing import Pool, shared_memory
 
 import numpy as np
 
+from PyCT.core import ReturnValues
 from PyCT.io import read_poscar
 
+# state of pathway pool workers, set once per worker process
+worker_state = {}
+
+
+def init_pathway_worker(hopping_pathways, shared_array_info, chunk_params):
+    """Attaches a pool worker to the shared image coordinate arrays"""
+    worker_state['hopping_pathways'] = hopping_pathways
+    worker_state['chunk_params'] = chunk_params
+    for array_name, (shm_name, shape, dtype) in shared_array_info.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        worker_state[array_name + '_shm'] = shm
+        worker_state[array_name] = np.ndarray(shape, dtype=dtype,
+                                              buffer=shm.buf)
+    return None
+
+
+def generate_pathway_chunk(center_site_fract_coords):
+    """Returns CSR pathway fragments of a chunk of center sites in a pool
+    worker"""
+    return worker_state['hopping_pathways'].generate_chunk_pathway_data(
+                center_site_fract_coords,
+                worker_state['neighbor_site_fract_coords'],
+                worker_state['system_fract_coords'],
+                *worker_state['chunk_params'])
+
 
 class HoppingPathways(object):
     """Class definition to generate charge transfer pathways"""
 
+    # number of center site chunks handed to each pool worker
+    CHUNKS_PER_WORKER = 4
+
     def __init__(self, input_coordinate_file_path, class_list):
         self.dst_path = input_coordinate_file_path.parent
         self.class_list = class_list
@@ -30,8 +59,8 @@ class HoppingPathways(object):
         # define derived parameters
         n_element_types = len(self.element_types)
         self.total_elements_per_unit_cell = self.n_elements_per_unit_cell.sum()
-        element_type_index_list = np.repeat(np.arange(n_element_types),
-                                            self.n_elements_per_unit_cell)
+        self.element_type_index_list = np.repeat(
+                np.arange(n_element_types), self.n_elements_per_unit_cell)
 
         # sort element wise coordinates in ascending order of z-coordinate
         start_index = 0
@@ -39,33 +68,12 @@ class HoppingPathways(object):
             end_index = start_index + self.n_elements_per_unit_cell[
                                                                 element_index]
             element_unit_cell_coords = self.fractional_unit_cell_coords[
-                                    element_type_index_list == element_index]
+                                self.element_type_index_list == element_index]
             self.fractional_unit_cell_coords[start_index:end_index] = (
                 element_unit_cell_coords[element_unit_cell_coords[:, 2].argsort()])
             start_index = end_index
         return None
 
-    def generate_quantum_indices(self, system_size, system_element_index,
-                                 n_elements_per_unit_cell):
-        """Returns the quantum indices of the element"""
-        quantum_indices = np.zeros(5, dtype=int)  # [0] * 5
-        total_elements_per_unit_cell = n_elements_per_unit_cell.sum()
-        unitcell_element_index = (system_element_index
-                                  % total_elements_per_unit_cell)
-        quantum_indices[3] = np.where(np.cumsum(n_elements_per_unit_cell)
-                                      >= (unitcell_element_index + 1))[0][0]
-        quantum_indices[4] = (
-                            unitcell_element_index
-                            - n_elements_per_unit_cell[:quantum_indices[3]].sum())
-        n_filled_unit_cells = ((system_element_index - unitcell_element_index)
-                               / total_elements_per_unit_cell)
-        for index in range(3):
-            quantum_indices[index] = (n_filled_unit_cells
-                                      / system_size[index+1:].prod())
-            n_filled_unit_cells -= (quantum_indices[index]
-                                    * system_size[index+1:].prod())
-        return quantum_indices
-
     def generate_avoid_element_indices(self, avoid_element_type, num_cells,
                                        center_site_element_type_index):
         if avoid_element_type:
@@ -83,45 +91,82 @@ class HoppingPathways(object):
             avoid_element_indices = []
         return avoid_element_indices
 
+    def generate_neighbor_data(self, center_site_fract_coords,
+                               image_site_fract_coords, cutoff_dist_limits):
+        """Returns CSR neighbor arrays of image sites within the cutoff
+        limits of each center site"""
+        lattice_directions = (image_site_fract_coords[None, :, :]
+                              - center_site_fract_coords[:, None, :])
+        displacements = np.linalg.norm(
+                    np.dot(lattice_directions, self.lattice_matrix), axis=2)
+        neighbor_mask = ((cutoff_dist_limits[0] < displacements)
+                         & (displacements <= cutoff_dist_limits[1]))
+        num_neighbors = neighbor_mask.sum(axis=1)
+        neighbor_site_indices = np.nonzero(neighbor_mask)[1]
+        neighbor_data = (num_neighbors, neighbor_site_indices,
+                         lattice_directions[neighbor_mask],
+                         displacements[neighbor_mask])
+        return neighbor_data
+
     def generate_bridge_neighbor_list(self, num_center_elements,
                                       center_site_fract_coords,
                                       system_fract_coords, avoid_element_indices,
                                       bridge_cutoff_dist_limits):
-        bridge_neighbor_list = np.empty(num_center_elements, dtype=object)
-        for center_site_index, center_site_fract_coord in enumerate(
-                                                    center_site_fract_coords):
-            i_bridge_neighbor_list = []
-            for neighbor_site_index, neighbor_site_fract_coord in enumerate(
-                                                        system_fract_coords):
-                if neighbor_site_index not in avoid_element_indices:
-                    lattice_direction = (neighbor_site_fract_coord
-                                         - center_site_fract_coord)
-                    neighbor_displacement_vector = np.dot(
-                            lattice_direction[None, :], self.lattice_matrix)
-                    displacement = np.linalg.norm(neighbor_displacement_vector)
-                    if (bridge_cutoff_dist_limits[0] < displacement
-                            <= bridge_cutoff_dist_limits[1]):
-                        i_bridge_neighbor_list.append(neighbor_site_index)
-            bridge_neighbor_list[center_site_index] = np.asarray(
-                                                        i_bridge_neighbor_list)
+        (num_bridge_neighbors, bridge_neighbor_indices, _, _) = \
+            self.generate_neighbor_data(center_site_fract_coords,
+                                        system_fract_coords,
+                                        bridge_cutoff_dist_limits)
+        if len(avoid_element_indices):
+            center_site_indices = np.repeat(np.arange(num_center_elements),
+                                            num_bridge_neighbors)
+            retain_mask = np.isin(bridge_neighbor_indices,
+                                  avoid_element_indices, invert=True)
+            bridge_neighbor_indices = bridge_neighbor_indices[retain_mask]
+            num_bridge_neighbors = np.bincount(
+                                    center_site_indices[retain_mask],
+                                    minlength=num_center_elements)
+        bridge_neighbor_list = (num_bridge_neighbors, bridge_neighbor_indices)
         return bridge_neighbor_list
-    
-    def generate_site_coordinates(self, center_site_element_type_index):
+
+    def generate_image_offsets(self, cutoff):
+        """Returns unit cell translations whose images may host sites within
+        the cutoff distance of a site in the reference unit cell"""
+        # perpendicular widths of the unit cell along each lattice direction
+        cell_volume = abs(np.linalg.det(self.lattice_matrix))
+        cell_widths = np.zeros(3)
+        for index in range(3):
+            face_normal = np.cross(self.lattice_matrix[(index + 1) % 3],
+                                   self.lattice_matrix[(index + 2) % 3])
+            cell_widths[index] = cell_volume / np.linalg.norm(face_normal)
+
+        # spread of the fractional coordinates within the unit cell
+        coord_extent = (self.fractional_unit_cell_coords.max(axis=0)
+                        - self.fractional_unit_cell_coords.min(axis=0))
+        max_offsets = np.floor(cutoff / cell_widths
+                               + coord_extent).astype(int)
+        min_singular_value = np.linalg.svd(self.lattice_matrix,
+                                           compute_uv=False)[-1]
+        image_offsets = []
+        for x_offset in range(-max_offsets[0], max_offsets[0] + 1):
+            for y_offset in range(-max_offsets[1], max_offsets[1] + 1):
+                for z_offset in range(-max_offsets[2], max_offsets[2] + 1):
+                    offset = np.array([x_offset, y_offset, z_offset])
+                    # lower bound of the separation between any pair of
+                    # sites in the reference cell and the image cell
+                    fract_gap = np.maximum(abs(offset) - coord_extent, 0)
+                    min_dist = max(np.max(fract_gap * cell_widths),
+                                   min_singular_value
+                                   * np.linalg.norm(fract_gap))
+                    if min_dist <= cutoff:
+                        image_offsets.append(offset)
+        return np.array(image_offsets)
+
+    def generate_site_coordinates(self, center_site_element_type_index,
+                                  cutoff):
         # generate array of unit cell translational coordinates
-        pbc = np.ones(3, int)
-        num_cells = 3**sum(pbc)
-        x_range = range(-1, 2) if pbc[0] == 1 else [0]
-        y_range = range(-1, 2) if pbc[1] == 1 else [0]
-        z_range = range(-1, 2) if pbc[2] == 1 else [0]
-        system_size = np.array([len(x_range), len(y_range), len(z_range)])
-        unitcell_translational_coords = np.zeros((num_cells, 3))  # Initialization
-        index = 0
-        for x_offset in x_range:
-            for y_offset in y_range:
-                for z_offset in z_range:
-                    unitcell_translational_coords[index] = np.array(
-                                                [x_offset, y_offset, z_offset])
-                    index += 1
+        unitcell_translational_coords = self.generate_image_offsets(
+                                                        cutoff).astype(float)
+        num_cells = len(unitcell_translational_coords)
 
         # extract center site fractional coordinates
         num_center_elements = self.n_elements_per_unit_cell[
@@ -146,140 +191,234 @@ class HoppingPathways(object):
                                     (i_cell + 1) * self.total_elements_per_unit_cell)] \
                                         = (self.fractional_unit_cell_coords
                                            + unitcell_translational_coords[i_cell])
-        site_coordinate_info = (system_size, num_cells, num_center_elements,
+        site_coordinate_info = (num_cells, num_center_elements,
                                 center_site_fract_coords,
                                 neighbor_site_fract_coords,
                                 system_fract_coords)
         return site_coordinate_info
 
+    def generate_chunk_pathway_data(self, center_site_fract_coords,
+                                    neighbor_site_fract_coords,
+                                    system_fract_coords, avoid_element_indices,
+                                    bridge_cutoff_dist_limits,
+                                    neighbor_cutoff_dist_limits):
+        """Returns CSR pathway fragments for a chunk of center sites"""
+        num_center_elements = len(center_site_fract_coords)
+        (num_bridge_neighbors, bridge_neighbor_indices) = \
+            self.generate_bridge_neighbor_list(
+                                num_center_elements, center_site_fract_coords,
+                                system_fract_coords, avoid_element_indices,
+                                bridge_cutoff_dist_limits)
+
+        # generate neighbor sites within cutoff of every center site
+        (num_neighbors, neighbor_site_indices, lattice_directions,
+         displacements) = self.generate_neighbor_data(
+                                center_site_fract_coords,
+                                neighbor_site_fract_coords,
+                                neighbor_cutoff_dist_limits)
+        center_site_indices = np.repeat(np.arange(num_center_elements),
+                                        num_neighbors)
+        num_pathways = len(displacements)
+
+        # determine bridging species from the bridge neighbors of the
+        # center site lying within bridge cutoff of the neighbor site
+        bridge_neighbor_offsets = np.append(0, np.cumsum(num_bridge_neighbors))
+        num_pathway_bridges = num_bridge_neighbors[center_site_indices]
+        pathway_bridge_offsets = np.append(0, np.cumsum(num_pathway_bridges))
+        bridge_pathway_indices = np.repeat(np.arange(num_pathways),
+                                           num_pathway_bridges)
+        bridge_positions = (
+            np.arange(pathway_bridge_offsets[-1])
+            - pathway_bridge_offsets[bridge_pathway_indices]
+            + bridge_neighbor_offsets[center_site_indices][
+                                                    bridge_pathway_indices])
+        bridge_site_indices = bridge_neighbor_indices[bridge_positions]
+        bridge_displacements = np.linalg.norm(np.dot(
+            neighbor_site_fract_coords[neighbor_site_indices][
+                                                    bridge_pathway_indices]
+            - system_fract_coords[bridge_site_indices], self.lattice_matrix),
+            axis=1)
+        bridge_mask = ((bridge_cutoff_dist_limits[0] < bridge_displacements)
+                       & (bridge_displacements <= bridge_cutoff_dist_limits[1]))
+        bridge_pathway_indices = bridge_pathway_indices[bridge_mask]
+        bridge_element_type_indices = self.element_type_index_list[
+                                        bridge_site_indices[bridge_mask]
+                                        % self.total_elements_per_unit_cell]
+        bridges = np.full(num_pathways, 'space', dtype=object)
+        (bridged_pathway_indices, bridge_counts) = np.unique(
+                                bridge_pathway_indices, return_counts=True)
+        for pathway_index, element_type_indices in zip(
+                        bridged_pathway_indices,
+                        np.split(bridge_element_type_indices,
+                                 np.cumsum(bridge_counts)[:-1])):
+            bridges[pathway_index] = ', '.join(
+                                        self.element_types[element_type_index]
+                                        for element_type_index
+                                        in element_type_indices)
+
+        chunk_pathway_data = (num_neighbors, neighbor_site_indices,
+                              lattice_directions, displacements,
+                              num_bridge_neighbors, bridges.astype(str))
+        return chunk_pathway_data
+
     def generate_raw_pathway_data(
-                    self, site_coordinate_info, bridge_neighbor_list,
+                    self, site_coordinate_info, avoid_element_indices,
                     bridge_cutoff_dist_limits, neighbor_cutoff_dist_limits,
-                    round_lattice_parameters, desired_coordinate_parameters):
-        (system_size, num_cells, num_center_elements, center_site_fract_coords,
+                    round_lattice_parameters, desired_coordinate_parameters,
+                    n_workers=1):
+        (num_cells, num_center_elements, center_site_fract_coords,
          neighbor_site_fract_coords, system_fract_coords) = site_coordinate_info
 
+        # split center sites into chunks processed serially or by a pool of
+        # workers sharing the image coordinate arrays
+        num_chunks = (n_workers * self.CHUNKS_PER_WORKER if n_workers > 1
+                      else 1)
+        center_site_chunks = [
+                    chunk for chunk in np.array_split(
+                            np.arange(num_center_elements), num_chunks)
+                    if len(chunk)]
+        chunk_params = (avoid_element_indices, bridge_cutoff_dist_limits,
+                        neighbor_cutoff_dist_limits)
+        if n_workers > 1:
+            shared_arrays = {}
+            try:
+                shared_array_info = {}
+                for array_name, array in (
+                        ('neighbor_site_fract_coords',
+                         neighbor_site_fract_coords),
+                        ('system_fract_coords', system_fract_coords)):
+                    shm = shared_memory.SharedMemory(create=True,
+                                                     size=array.nbytes)
+                    shared_arrays[array_name] = shm
+                    np.ndarray(array.shape, dtype=array.dtype,
+                               buffer=shm.buf)[:] = array
+                    shared_array_info[array_name] = (shm.name, array.shape,
+                                                     array.dtype)
+                with Pool(n_workers, initializer=init_pathway_worker,
+                          initargs=(self, shared_array_info,
+                                    chunk_params)) as pool:
+                    chunk_pathway_data_list = pool.map(
+                        generate_pathway_chunk,
+                        [center_site_fract_coords[chunk]
+                         for chunk in center_site_chunks])
+            finally:
+                for shm in shared_arrays.values():
+                    shm.close()
+                    shm.unlink()
+        else:
+            chunk_pathway_data_list = [
+                self.generate_chunk_pathway_data(
+                            center_site_fract_coords[chunk],
+                            neighbor_site_fract_coords, system_fract_coords,
+                            *chunk_params)
+                for chunk in center_site_chunks]
+
+        # concatenate chunk fragments in the order of center sites
+        (num_neighbors, neighbor_site_indices, lattice_directions,
+         displacements, num_bridge_neighbors, bridges) = [
+                np.concatenate(fragments)
+                for fragments in zip(*chunk_pathway_data_list)]
+        center_site_indices = np.repeat(np.arange(num_center_elements),
+                                        num_neighbors)
+
         if round_lattice_parameters:
             base = round_lattice_parameters['base']
             prec = round_lattice_parameters['prec']
+            lattice_directions = np.round(
+                        base * np.round(lattice_directions / base), prec)
 
         # initialize class pair list
         if self.class_list:
             center_site_class_list = self.class_list[0]
             neighbor_site_class_list = np.tile(self.class_list[1], num_cells)
-            class_pair_list = np.empty(num_center_elements, dtype=object)
-
-
-        displacement_vector_list = np.empty(num_center_elements, dtype=object)
-        lattice_direction_list = np.empty(num_center_elements, dtype=object)
-        displacement_list = np.empty(num_center_elements, dtype=object)
-        bridge_list = np.empty(num_center_elements, dtype=object)
-        num_neighbors = np.zeros(num_center_elements, dtype=int)
-        for center_site_index, center_site_fract_coord in enumerate(
-                                                    center_site_fract_coords):
-            i_displacement_vectors = []
-            i_lattice_direction_list = []
-            i_displacements = []
-            i_bridge_list = []
-            if self.class_list:
-                i_class_pair_list = []
-            for neighbor_site_index, neighbor_site_fract_coord in enumerate(
-                                                neighbor_site_fract_coords):
-                lattice_direction = (neighbor_site_fract_coord
-                                     - center_site_fract_coord)
-                neighbor_displacement_vector = np.dot(
-                            lattice_direction[None, :], self.lattice_matrix)
-                displacement = np.linalg.norm(neighbor_displacement_vector)
-                if (neighbor_cutoff_dist_limits[0]
-                        < displacement
-                        <= neighbor_cutoff_dist_limits[1]):
-                    i_displacement_vectors.append(neighbor_displacement_vector)
-                    i_displacements.append(displacement)
-                    num_neighbors[center_site_index] += 1
-                    if round_lattice_parameters:
-                        lattice_direction = np.round(
-                                (base * np.round((lattice_direction) / base)),
-                                prec)
-                    i_lattice_direction_list.append(lattice_direction)
-    
-                    # print fractional coordinates in the desired super cell size
-                    if desired_coordinate_parameters:
-                        desired_system_size = desired_coordinate_parameters[
-                                                        'desired_system_size']
-                        dist_list = desired_coordinate_parameters['dist_list']
-                        prec = desired_coordinate_parameters['prec']
-                        dist = np.round(displacement, prec)
-                        if dist in dist_list:
-                            print(dist)
-                            print('center class:',
-                                  center_site_class_list[center_site_index])
-                            print('neighbor class:',
-                                  neighbor_site_class_list[neighbor_site_index])
-                            print('num of bonds:',
-                                  len(bridge_neighbor_list[center_site_index]))
-                            print('center:',
-                                  np.round(np.divide(center_site_fract_coord,
-                                                     desired_system_size), 3))
-                            print('neighbor:',
-                                  np.round(np.divide(neighbor_site_fract_coord,
-                                                     desired_system_size), 3))
-    
-                    # determine class pair list
-                    if self.class_list:
-                        i_class_pair_list.append(
-                                str(center_site_class_list[center_site_index])
-                                + ':' + str(neighbor_site_class_list[
-                                                        neighbor_site_index]))
-    
-                    # determine bridging species
-                    bridge_site_exists = 0
-                    bridge_site_type = ''
-                    for i_center_neighbor_se_index in bridge_neighbor_list[
-                                                            center_site_index]:
-                        i_center_neighbor_fract_coord = system_fract_coords[
-                                                    i_center_neighbor_se_index]
-                        bridgelattice_direction = (
-                                            neighbor_site_fract_coord
-                                            - i_center_neighbor_fract_coord)
-                        bridgeneighbor_displacement_vector = np.dot(
-                                            bridgelattice_direction[None, :],
-                                            self.lattice_matrix)
-                        bridgedisplacement = np.linalg.norm(
-                                            bridgeneighbor_displacement_vector)
-                        if (bridge_cutoff_dist_limits[0]
-                                < bridgedisplacement
-                                <= bridge_cutoff_dist_limits[1]):
-                            bridge_site_exists = 1
-                            bridge_site_index = i_center_neighbor_se_index
-                            bridge_site_quantum_indices = (
-                                    self.generate_quantum_indices(
-                                                system_size, bridge_site_index,
-                                                self.n_elements_per_unit_cell))
-                            bridge_site_type += (
-                                (', ' if bridge_site_type != '' else '')
-                                + self.element_types[bridge_site_quantum_indices[3]])
-                    if not bridge_site_exists:
-                        bridge_site_type = 'space'
-                    i_bridge_list.append(bridge_site_type)
-    
-            bridge_list[center_site_index] = np.asarray(i_bridge_list)
-            displacement_vector_list[center_site_index] = np.asarray(
-                                                        i_displacement_vectors)
-            lattice_direction_list[center_site_index] = np.asarray(
-                                                    i_lattice_direction_list)
-            displacement_list[center_site_index] = np.asarray(i_displacements)
-            if self.class_list:
-                class_pair_list[center_site_index] = np.asarray(
-                                                            i_class_pair_list)
-        pathway_data = (displacement_list, bridge_list, lattice_direction_list,
-                        num_neighbors, class_pair_list, center_site_class_list)
+
+        # export fractional coordinates in the desired super cell size
+        if desired_coordinate_parameters:
+            self.export_desired_coordinate_data(
+                    desired_coordinate_parameters, displacements,
+                    center_site_indices, neighbor_site_indices,
+                    num_bridge_neighbors, center_site_fract_coords,
+                    neighbor_site_fract_coords, num_cells)
+
+        # determine class pair list
+        if self.class_list:
+            class_pairs = np.char.add(
+                np.char.add(np.asarray(center_site_class_list).astype(str)[
+                                                    center_site_indices], ':'),
+                neighbor_site_class_list.astype(str)[neighbor_site_indices])
+        else:
+            class_pairs = None
+            center_site_class_list = None
+
+        pathway_data = (displacements, bridges, lattice_directions,
+                        num_neighbors, class_pairs, center_site_class_list)
         return pathway_data
 
+    def export_desired_coordinate_data(
+                self, desired_coordinate_parameters, displacements,
+                center_site_indices, neighbor_site_indices,
+                num_bridge_neighbors, center_site_fract_coords,
+                neighbor_site_fract_coords, num_cells):
+        """Writes pathways of the desired distances with site coordinates
+        in the desired super cell size to csv and npz files"""
+        desired_system_size = desired_coordinate_parameters[
+                                                    'desired_system_size']
+        dist_list = desired_coordinate_parameters['dist_list']
+        prec = desired_coordinate_parameters['prec']
+        print_summary = desired_coordinate_parameters.get('print_summary',
+                                                          False)
+        dists = np.round(displacements, prec)
+        pathway_indices = np.flatnonzero(np.isin(dists, dist_list))
+        center_site_indices = center_site_indices[pathway_indices]
+        neighbor_site_indices = neighbor_site_indices[pathway_indices]
+        if self.class_list:
+            center_classes = np.asarray(self.class_list[0]).astype(str)[
+                                                        center_site_indices]
+            neighbor_classes = np.tile(self.class_list[1], num_cells).astype(
+                                                str)[neighbor_site_indices]
+        else:
+            center_classes = np.full(len(pathway_indices), '')
+            neighbor_classes = np.full(len(pathway_indices), '')
+        desired_coordinate_data = {
+            'dist': dists[pathway_indices],
+            'center_class': center_classes,
+            'neighbor_class': neighbor_classes,
+            'num_bonds': num_bridge_neighbors[center_site_indices],
+            'center': np.round(np.divide(
+                            center_site_fract_coords[center_site_indices],
+                            desired_system_size), 3),
+            'neighbor': np.round(np.divide(
+                            neighbor_site_fract_coords[neighbor_site_indices],
+                            desired_system_size), 3)}
+
+        data_file_name = 'desired_coordinate_data'
+        np.savez(self.dst_path / (data_file_name + '.npz'),
+                 **desired_coordinate_data)
+        data_table = np.hstack((
+                    desired_coordinate_data['dist'][:, None].astype(str),
+                    center_classes[:, None], neighbor_classes[:, None],
+                    desired_coordinate_data['num_bonds'][:, None].astype(str),
+                    desired_coordinate_data['center'].astype(str),
+                    desired_coordinate_data['neighbor'].astype(str)))
+        header = ','.join(['dist', 'center_class', 'neighbor_class',
+                           'num_bonds', 'center_x', 'center_y', 'center_z',
+                           'neighbor_x', 'neighbor_y', 'neighbor_z'])
+        np.savetxt(self.dst_path / (data_file_name + '.csv'), data_table,
+                   fmt='%s', delimiter=',', header=header, comments='')
+
+        if print_summary:
+            print(f'{len(pathway_indices)} pathways at desired distances:')
+            (unique_dists, dist_counts) = np.unique(
+                        desired_coordinate_data['dist'], return_counts=True)
+            for dist, dist_count in zip(unique_dists, dist_counts):
+                print(f'{dist}: {dist_count}')
+        return desired_coordinate_data
+
     def generate_reduced_pathway_data(self, pathway_data, num_center_elements,
                                       round_lattice_parameters,
                                       precision_parameters, print_parameters):
-        (displacement_list, bridge_list, lattice_direction_list,
-         num_neighbors, class_pair_list, center_site_class_list) = pathway_data
+        (displacements, bridges, lattice_directions,
+         num_neighbors, class_pairs, _) = pathway_data
         if round_lattice_parameters:
             base = round_lattice_parameters['base']
         equivalency_prec = precision_parameters['equivalency']
@@ -287,99 +426,61 @@ class HoppingPathways(object):
         print_equivalency = print_parameters['equivalency']
         print_pathway_list = print_parameters['pathway_list']
 
+        neighbor_offsets = np.append(0, np.cumsum(num_neighbors))
+        center_site_indices = np.repeat(np.arange(num_center_elements),
+                                        num_neighbors)
 
         # determine irreducible form of lattice directions
-        sorted_lattice_direction_list = np.empty(num_center_elements,
-                                                 dtype=object)
-        sorted_displacement_list = np.empty(num_center_elements, dtype=object)
+        if round_lattice_parameters:
+            lattice_directions = np.round(lattice_directions
+                                          / base).astype(int)
+            lattice_direction_gcd = np.gcd.reduce(lattice_directions, axis=1)
+            lattice_direction_gcd[lattice_direction_gcd == 0] = 1
+            lattice_directions //= lattice_direction_gcd[:, None]
+
+        # sort neighbors of each center site in ascending order of
+        # displacement; ties retain the order of the neighbor search
+        sort_indices = np.lexsort((displacements, center_site_indices))
+        sorted_displacements = displacements[sort_indices]
+
+        # print equivalency of all center sites with the reference site
+        if print_equivalency:
+            ref_index = 0
+            rounded_displacements = np.round(sorted_displacements,
+                                             equivalency_prec)
+            ref_displacements = rounded_displacements[
+                neighbor_offsets[ref_index]:neighbor_offsets[ref_index + 1]]
+            for i_center_element_index in range(num_center_elements):
+                print(np.array_equal(
+                    ref_displacements,
+                    rounded_displacements[
+                        neighbor_offsets[i_center_element_index]:
+                        neighbor_offsets[i_center_element_index + 1]]))
+
+        # generate pathway table of all center sites
+        pathway_columns = [
+                    np.round(lattice_directions[sort_indices], pathway_prec),
+                    np.round(sorted_displacements, pathway_prec)[:, None]]
         if self.class_list:
-            sorted_class_pair_list = np.empty(num_center_elements,
-                                              dtype=object)
-        sorted_bridge_list = np.empty(num_center_elements, dtype=object)
+            pathway_columns.append(class_pairs[sort_indices][:, None])
+        pathway_columns.append(bridges[sort_indices][:, None])
+        pathway_table = np.hstack(pathway_columns)
+
         pathway_list = np.empty(num_center_elements, dtype=object)
-        for i_center_element_index in range(num_center_elements):
-            sorted_displacement_list[i_center_element_index] = (
-                    displacement_list[i_center_element_index][
-                        displacement_list[i_center_element_index].argsort()])
-            sorted_bridge_list[i_center_element_index] = (
-                    bridge_list[i_center_element_index][
-                        displacement_list[i_center_element_index].argsort()])
-            if self.class_list:
-                sorted_class_pair_list[i_center_element_index] = (
-                    class_pair_list[i_center_element_index][
-                        displacement_list[i_center_element_index].argsort()])
-            if round_lattice_parameters:
-                lattice_direction_list[i_center_element_index] = np.round(
-                                lattice_direction_list[i_center_element_index]
-                                / base).astype(int)
-                center_site_l_d_list = lattice_direction_list[
-                                                        i_center_element_index]
-                for index in range(num_neighbors[i_center_element_index]):
-                    center_site_abs_l_d_list = abs(center_site_l_d_list[index])
-                    nz = np.nonzero(center_site_abs_l_d_list)[0]
-                    nz_center_site_abs_l_dlist = center_site_abs_l_d_list[nz]
-                    if len(nz) == 1:
-                        lattice_direction_list[i_center_element_index][
-                            index] = (center_site_l_d_list[index]
-                                      / center_site_abs_l_d_list[nz])
-                    elif len(nz) == 2:
-                        lattice_direction_list[i_center_element_index][
-                            index] = (center_site_l_d_list[index]
-                                      / gcd(nz_center_site_abs_l_dlist[0],
-                                            nz_center_site_abs_l_dlist[1]))
-                    else:
-                        lattice_direction_list[i_center_element_index][
-                            index] = (center_site_l_d_list[index]
-                                      / gcd(gcd(nz_center_site_abs_l_dlist[0],
-                                                nz_center_site_abs_l_dlist[1]),
-                                                nz_center_site_abs_l_dlist[2]))
-            sorted_lattice_direction_list[i_center_element_index] = (
-                lattice_direction_list[i_center_element_index][
-                        displacement_list[i_center_element_index].argsort()])
-    
-            # print equivalency of all center sites with their
-            # respective class reference site
-            if print_equivalency:
-                if self.class_list:
-                    ref_index = (np.argmax(center_site_class_list
-                                           == center_site_class_list[
-                                               i_center_element_index]))
-                    ref_index = 0
-                print(
-                    np.array_equal(np.round(sorted_displacement_list[ref_index],
-                                            equivalency_prec),
-                                   np.round(sorted_displacement_list[
-                                       i_center_element_index],
-                                       equivalency_prec)))
-    
-            # generate center site pathway list
-            if self.class_list:
-                center_site_pathway_list = np.hstack((
-                        np.round(sorted_lattice_direction_list[
-                                                        i_center_element_index],
-                                 pathway_prec),
-                        np.round(sorted_displacement_list[i_center_element_index],
-                                 pathway_prec)[:, None],
-                        sorted_class_pair_list[i_center_element_index][:, None],
-                        sorted_bridge_list[i_center_element_index][:, None]))
-            else:
-                center_site_pathway_list = np.hstack((
-                        np.round(sorted_lattice_direction_list[i_center_element_index],
-                                 pathway_prec),
-                        np.round(sorted_displacement_list[i_center_element_index],
-                                 pathway_prec)[:, None],
-                        sorted_bridge_list[i_center_element_index][:, None]))
+        for i_center_element_index, center_site_pathway_list in enumerate(
+                    np.split(pathway_table, neighbor_offsets[1:-1])):
             pathway_list[i_center_element_index] = center_site_pathway_list
-    
-            if print_pathway_list:
-                np.set_printoptions(suppress=True)
-                print(center_site_pathway_list)
 
+        if print_pathway_list:
+            np.set_printoptions(suppress=True)
+            for center_site_pathway_list in pathway_list:
+                print(center_site_pathway_list)
         return pathway_list
 
     def generate_pathway_list(self, cutoff_dist_key, cutoff,
                               avoid_element_type, precision_parameters,
-                              print_parameters, desired_coordinate_parameters):
+                              print_parameters, desired_coordinate_parameters,
+                              n_workers=1):
         """ generate pathway list for the given set of element types"""
         # define input parameters
         neighbor_cutoff = cutoff['neighbor']
@@ -393,25 +494,20 @@ class HoppingPathways(object):
         bridge_cutoff_dist_limits = [0, bridge_cutoff]
     
         site_coordinate_info = self.generate_site_coordinates(
-                                                center_site_element_type_index)
-        (_, num_cells, num_center_elements, center_site_fract_coords, _,
-         system_fract_coords) = site_coordinate_info
+                                center_site_element_type_index,
+                                max(neighbor_cutoff, bridge_cutoff))
+        (num_cells, num_center_elements, _, _, _) = site_coordinate_info
     
         # generate list of element indices to avoid during bridge calculations
         avoid_element_indices = self.generate_avoid_element_indices(
                 avoid_element_type, num_cells, center_site_element_type_index)
 
-        # generate bridge neighbor list
-        bridge_neighbor_list = self.generate_bridge_neighbor_list(
-                                num_center_elements, center_site_fract_coords,
-                                system_fract_coords, avoid_element_indices,
-                                bridge_cutoff_dist_limits)
-
         # generate pathway data
         pathway_data = self.generate_raw_pathway_data(
-                    site_coordinate_info, bridge_neighbor_list,
+                    site_coordinate_info, avoid_element_indices,
                     bridge_cutoff_dist_limits, neighbor_cutoff_dist_limits,
-                    round_lattice_parameters, desired_coordinate_parameters)
+                    round_lattice_parameters, desired_coordinate_parameters,
+                    n_workers)
 
         pathway_list = self.generate_reduced_pathway_data(
                 pathway_data, num_center_elements, round_lattice_parameters,
@@ -422,3 +518,144 @@ class HoppingPathways(object):
         pathway_file_path = self.dst_path / pathway_file_name
         np.save(pathway_file_path, pathway_list)
         return
+
+    def generate_hop_neighbor_list(self, system_size, neighbor_cutoff_dist,
+                                   neighbor_cutoff_dist_tol):
+        """Returns the hop neighbor list of the supercell by mapping unit
+        cell neighbors onto every unit cell of the supercell"""
+        system_size = np.asarray(system_size)
+        num_cells = system_size.prod()
+        cell_indices = np.array(np.unravel_index(np.arange(num_cells),
+                                                 system_size)).T
+        element_offsets = np.append(0, np.cumsum(self.n_elements_per_unit_cell))
+        hop_neighbor_list = {}
+        for cutoff_dist_key, cutoff_dist_list in neighbor_cutoff_dist.items():
+            [center_element_type, neighbor_element_type] = cutoff_dist_key.split(':')
+            center_element_type_index = self.element_types.index(
+                                                        center_element_type)
+            neighbor_element_type_index = self.element_types.index(
+                                                        neighbor_element_type)
+            center_site_indices = np.arange(
+                                element_offsets[center_element_type_index],
+                                element_offsets[center_element_type_index + 1])
+            neighbor_site_indices = np.arange(
+                            element_offsets[neighbor_element_type_index],
+                            element_offsets[neighbor_element_type_index + 1])
+            num_center_elements = len(center_site_indices)
+            num_neighbor_elements = len(neighbor_site_indices)
+            neighbor_list_cutoff_dist_key = []
+            for index, cutoff_dist in enumerate(cutoff_dist_list):
+                tol_dist = neighbor_cutoff_dist_tol[cutoff_dist_key][index]
+                cutoff_dist_limits = [cutoff_dist - tol_dist,
+                                      cutoff_dist + tol_dist]
+                image_offsets = self.generate_image_offsets(
+                                                    cutoff_dist_limits[1])
+                image_site_fract_coords = (
+                    self.fractional_unit_cell_coords[neighbor_site_indices][
+                                                                None, :, :]
+                    + image_offsets[:, None, :]).reshape(-1, 3)
+                (num_neighbors, image_site_indices, lattice_directions, _) = \
+                    self.generate_neighbor_data(
+                        self.fractional_unit_cell_coords[center_site_indices],
+                        image_site_fract_coords, cutoff_dist_limits)
+                displacement_vectors = np.dot(lattice_directions,
+                                              self.lattice_matrix)
+                (image_indices, neighbor_indices) = np.divmod(
+                                    image_site_indices, num_neighbor_elements)
+
+                # translate unit cell neighbors to every cell in the supercell
+                neighbor_cell_indices = (
+                            (cell_indices[:, None, :]
+                             + image_offsets[image_indices][None, :, :])
+                            % system_size)
+                neighbor_system_element_indices = (
+                    np.ravel_multi_index(
+                        tuple(np.moveaxis(neighbor_cell_indices, -1, 0)),
+                        system_size) * self.total_elements_per_unit_cell
+                    + neighbor_site_indices[neighbor_indices]).ravel()
+                center_indices = (
+                    np.arange(num_cells)[:, None] * num_center_elements
+                    + np.repeat(np.arange(num_center_elements),
+                                num_neighbors)[None, :]).ravel()
+                sort_indices = np.lexsort((neighbor_system_element_indices,
+                                           center_indices))
+                system_num_neighbors = np.tile(num_neighbors, num_cells)
+                split_indices = np.cumsum(system_num_neighbors)[:-1]
+                system_displacement_vectors = np.tile(
+                                displacement_vectors, (num_cells, 1))
+                neighbor_system_element_index_list = np.empty(
+                            num_cells * num_center_elements, dtype=object)
+                displacement_vector_list = np.empty(
+                            num_cells * num_center_elements, dtype=object)
+                for system_center_index, (i_neighbor_indices, i_vectors) in \
+                        enumerate(zip(
+                            np.split(neighbor_system_element_indices[
+                                        sort_indices], split_indices),
+                            np.split(system_displacement_vectors[
+                                        sort_indices], split_indices))):
+                    neighbor_system_element_index_list[
+                                    system_center_index] = i_neighbor_indices
+                    displacement_vector_list[system_center_index] = i_vectors
+                neighbor_list_cutoff_dist_key.append(ReturnValues(
+                    neighbor_system_element_indices=neighbor_system_element_index_list,
+                    displacement_vector_list=displacement_vector_list,
+                    num_neighbors=system_num_neighbors))
+            hop_neighbor_list[cutoff_dist_key] = neighbor_list_cutoff_dist_key
+        return hop_neighbor_list
+
+    def generate_cumulative_displacement_list(self, system_size):
+        """Returns minimum image displacement vectors between all pairs of
+        sites in the supercell"""
+        system_size = np.asarray(system_size)
+        num_cells = system_size.prod()
+        num_sites = self.total_elements_per_unit_cell
+        cell_indices = np.array(np.unravel_index(np.arange(num_cells),
+                                                 system_size)).T
+
+        # minimum image displacements between unit cell sites separated by
+        # every cell translation of the supercell
+        pair_lattice_directions = (
+                            self.fractional_unit_cell_coords[None, None, :, :]
+                            - self.fractional_unit_cell_coords[None, :, None, :]
+                            + cell_indices[:, None, None, :])
+        cell_displacement_vectors = np.zeros((num_cells, num_sites,
+                                              num_sites, 3))
+        cell_displacements = np.full((num_cells, num_sites, num_sites), np.inf)
+        for x_offset in range(-1, 2):
+            for y_offset in range(-1, 2):
+                for z_offset in range(-1, 2):
+                    image_displacement_vectors = np.dot(
+                        pair_lattice_directions
+                        + np.array([x_offset, y_offset, z_offset]) * system_size,
+                        self.lattice_matrix)
+                    image_displacements = np.linalg.norm(
+                                        image_displacement_vectors, axis=3)
+                    min_mask = image_displacements < cell_displacements
+                    cell_displacements[min_mask] = image_displacements[min_mask]
+                    cell_displacement_vectors[min_mask] = \
+                        image_displacement_vectors[min_mask]
+
+        cell_separation_indices = np.ravel_multi_index(
+            tuple(np.moveaxis((cell_indices[None, :, :]
+                               - cell_indices[:, None, :]) % system_size,
+                              -1, 0)), system_size)
+        site_indices = np.arange(num_sites)
+        cumulative_displacement_list = cell_displacement_vectors[
+                                    cell_separation_indices[:, None, :, None],
+                                    site_indices[None, :, None, None],
+                                    site_indices[None, None, None, :]]
+        num_system_elements = num_cells * num_sites
+        return cumulative_displacement_list.reshape(
+                            (num_system_elements, num_system_elements, 3))
+
+    def generate_neighbor_input_files(self, system_size, neighbor_cutoff_dist,
+                                      neighbor_cutoff_dist_tol):
+        """Generates supercell-level neighbor input files for PyCD"""
+        hop_neighbor_list = self.generate_hop_neighbor_list(
+                system_size, neighbor_cutoff_dist, neighbor_cutoff_dist_tol)
+        np.save(self.dst_path / 'hop_neighbor_list.npy', hop_neighbor_list)
+        cumulative_displacement_list = \
+            self.generate_cumulative_displacement_list(system_size)
+        np.save(self.dst_path / 'cumulative_displacement_list.npy',
+                cumulative_displacement_list)
+        return None
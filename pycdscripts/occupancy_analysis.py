@@ -2,138 +2,333 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-import re
+from collections import OrderedDict
+from contextlib import nullcontext
+from functools import partial
+import io
+from multiprocessing import Pool
 
 import numpy as np
 from scipy.stats import linregress
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 
+from pycdscripts.segment_map import get_site_segment_map
+
 
 class Occupancy(object):
     """Class definition to generate occupancy histogram files"""
 
-    def __init__(self, src_path, color_list):
+    # number of bytes parsed at a time from trajectory text files
+    READ_BLOCK_SIZE = 2**26
+    # default upper bound on the bytes held by the parsed trajectory cache
+    CACHE_SIZE = 2**31
+
+    def __init__(self, src_path, color_list, cache_size=CACHE_SIZE):
         # Load occupancy parameters
         self.color_list = color_list
         self.num_colors = len(self.color_list)
         self.src_path = src_path
+
+        # least recently used cache of parsed per-trajectory data
+        self.cache_size = cache_size
+        self.trajectory_cache = OrderedDict()
+        self.cache_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
         return None
 
+    def __getstate__(self):
+        # pool workers start from an empty cache
+        state = self.__dict__.copy()
+        state['trajectory_cache'] = OrderedDict()
+        state['cache_bytes'] = 0
+        return state
+
+    def get_data_size(self, data):
+        """Returns the number of bytes held by arrays within data"""
+        if isinstance(data, np.ndarray):
+            return data.nbytes
+        if isinstance(data, (list, tuple)):
+            return sum(self.get_data_size(item) for item in data)
+        return 0
+
+    def get_cached_data(self, key, load_data):
+        """Returns the cached value of key, calling load_data on a miss and
+        evicting least recently used entries beyond cache_size bytes"""
+        if key in self.trajectory_cache:
+            self.cache_hits += 1
+            self.trajectory_cache.move_to_end(key)
+            return self.trajectory_cache[key][0]
+        self.cache_misses += 1
+        data = load_data()
+        data_size = self.get_data_size(data)
+        if data_size <= self.cache_size:
+            while self.cache_bytes + data_size > self.cache_size:
+                (_, (_, evicted_size)) = self.trajectory_cache.popitem(
+                                                                    last=False)
+                self.cache_bytes -= evicted_size
+            self.trajectory_cache[key] = (data, data_size)
+            self.cache_bytes += data_size
+        return data
+
+    def get_cache_stats(self):
+        """Returns hit and size statistics of the parsed trajectory cache"""
+        num_requests = self.cache_hits + self.cache_misses
+        cache_stats = {'hits': self.cache_hits,
+                       'misses': self.cache_misses,
+                       'hit_ratio': (self.cache_hits / num_requests
+                                     if num_requests else 0.0),
+                       'num_entries': len(self.trajectory_cache),
+                       'bytes': self.cache_bytes,
+                       'cache_size': self.cache_size}
+        return cache_stats
+
     def generate_occupancy_histogram(self, shell_wise, res_time, site_wise,
                                      barrier_shell_index, n_traj,
-                                     output_traj_length):
+                                     output_traj_length, n_workers=1,
+                                     num_site_bins=None,
+                                     site_bin_statistic='max',
+                                     combined_site_wise=False):
         traj_length_array = np.zeros(n_traj, dtype=int)
-        for traj_index in range(n_traj):
-            traj_number = traj_index + 1
-            (num_shells, probe_indices, site_population_list,
-             traj_res_time_pool, num_kmc_steps) = self.read_trajectory_data(
-                                    traj_number, res_time, barrier_shell_index)
-            traj_length_array[traj_index] = num_kmc_steps
-            if site_wise:
-                self.generate_site_wise_occpancy(num_shells,
-                                                 probe_indices,
-                                                 site_population_list,
-                                                 traj_number)
-            if shell_wise:
-                if traj_number == 1:
-                    site_population_repo = []
-                site_population_repo.append(site_population_list)
-                if traj_number == n_traj:
-                    self.generate_shell_wise_occupancy(num_shells,
-                                                       site_population_repo,
-                                                       n_traj)
-            if res_time:
-                if traj_number == 1:
-                    res_time_pool = []
-                res_time_pool.append(traj_res_time_pool)
-                if traj_number == n_traj:
-                    self.generate_res_time_distribution(res_time_pool, n_traj)
+        # running sums over trajectories keep memory independent of n_traj
+        fraction_sum = fraction_sq_sum = 0
+        res_time_freq_sum = np.zeros(0)
+        res_time_freq_sq_sum = np.zeros(0)
+        mean_residence_length_sum = mean_residence_length_sq_sum = 0
+        binned_population_repo = []
+        count_trajectory = partial(self.get_trajectory_counts,
+                                   res_time=res_time,
+                                   barrier_shell_index=barrier_shell_index,
+                                   site_wise=site_wise)
+        traj_numbers = range(1, n_traj + 1)
+        with (Pool(n_workers) if n_workers > 1 else nullcontext()) as pool:
+            if pool is not None:
+                traj_counts = pool.imap(count_trajectory, traj_numbers)
+            else:
+                traj_counts = map(count_trajectory, traj_numbers)
+            for traj_number, (num_shells, shell_population, res_time_freq,
+                              mean_residence_length, num_kmc_steps,
+                              site_population_list) in zip(traj_numbers,
+                                                           traj_counts):
+                traj_length_array[traj_number - 1] = num_kmc_steps
+                if site_wise:
+                    binned_population_list = [
+                            self.get_binned_site_population(
+                                site_population, num_site_bins, site_bin_statistic)
+                            for site_population in site_population_list]
+                    if combined_site_wise:
+                        binned_population_repo.append(binned_population_list)
+                    else:
+                        self.generate_site_wise_occpancy(num_shells,
+                                                         binned_population_list,
+                                                         traj_number,
+                                                         num_site_bins)
+                if shell_wise:
+                    # population of the outermost shell is not reported
+                    fraction_values = shell_population / shell_population.sum()
+                    fraction_values[-1] = 0
+                    fraction_sum = fraction_sum + fraction_values
+                    fraction_sq_sum = fraction_sq_sum + fraction_values**2
+                if res_time:
+                    res_time_freq_sum = self.accumulate_histogram(
+                                            res_time_freq_sum, res_time_freq)
+                    res_time_freq_sq_sum = self.accumulate_histogram(
+                                            res_time_freq_sq_sum, res_time_freq**2)
+                    mean_residence_length_sum += mean_residence_length
+                    mean_residence_length_sq_sum += mean_residence_length**2
+        if site_wise and combined_site_wise:
+            self.generate_combined_site_wise_occupancy(
+                    num_shells, binned_population_repo, n_traj)
+        if shell_wise:
+            self.generate_shell_wise_occupancy(num_shells, fraction_sum,
+                                               fraction_sq_sum, n_traj)
+        if res_time:
+            self.generate_res_time_distribution(
+                    res_time_freq_sum, res_time_freq_sq_sum,
+                    mean_residence_length_sum, mean_residence_length_sq_sum,
+                    n_traj)
         if output_traj_length:
             np.savetxt('traj_length_data.dat', traj_length_array)
         return None
 
-    def read_trajectory_data(self, traj_number, res_time, barrier_shell_index):
+    def get_trajectory_counts(self, traj_number, res_time, barrier_shell_index,
+                              site_wise):
+        """Returns fixed-size shell populations and the residence length
+        histogram of a single trajectory"""
+        (num_shells, probe_indices, site_population_list,
+         traj_res_time_pool, num_kmc_steps) = self.read_trajectory_data(
+                                    traj_number, res_time, barrier_shell_index)
+        shell_population = np.array([np.sum(site_population)
+                                     for site_population in site_population_list])
+        res_time_freq = np.bincount(traj_res_time_pool)
+        if len(traj_res_time_pool):
+            mean_residence_length = traj_res_time_pool.mean()
+        else:
+            mean_residence_length = np.nan
+        if not site_wise:
+            site_population_list = None
+        return (num_shells, shell_population, res_time_freq,
+                mean_residence_length, num_kmc_steps, site_population_list)
+
+    def accumulate_histogram(self, cumulative_freq, freq):
+        """Adds a histogram to a running histogram sum of a possibly
+        different length"""
+        num_bins = max(len(cumulative_freq), len(freq))
+        cumulative_freq = np.pad(cumulative_freq,
+                                 (0, num_bins - len(cumulative_freq)))
+        cumulative_freq[:len(freq)] += freq
+        return cumulative_freq
+
+    def load_text_data(self, file_path, delimiter=None):
+        """Returns the integer table of a text file, parsed in large blocks
+        and cached to a sibling .npy file"""
+        cache_file_path = file_path.with_suffix('.npy')
+        stat_file_path = file_path.with_suffix('.npy.stat')
+        file_stat = file_path.stat()
+        file_signature = f'{file_stat.st_size} {file_stat.st_mtime_ns}'
+        if cache_file_path.exists() and stat_file_path.exists():
+            with stat_file_path.open('r') as stat_file:
+                if stat_file.read().strip() == file_signature:
+                    return np.load(cache_file_path)
+
+        data_blocks = []
+        remainder = b''
+        with file_path.open('rb') as data_file:
+            while True:
+                chunk = data_file.read(self.READ_BLOCK_SIZE)
+                block = remainder + chunk
+                if chunk:
+                    # retain the trailing partial line for the next block
+                    split_index = block.rfind(b'\n') + 1
+                    (block, remainder) = (block[:split_index],
+                                          block[split_index:])
+                if block.strip():
+                    data_blocks.append(np.loadtxt(io.BytesIO(block), dtype=int,
+                                                  delimiter=delimiter, ndmin=2))
+                if not chunk:
+                    break
+        data = np.concatenate(data_blocks)
+
+        try:
+            np.save(cache_file_path, data)
+            with stat_file_path.open('w') as stat_file:
+                stat_file.write(file_signature)
+        except OSError:
+            # read-only data directories are parsed afresh on every call
+            pass
+        return data
+
+    def read_site_indices_data(self, traj_number):
         site_indices_dir_name = 'site_indices_data'
         site_indices_file_name = f'site_indices_{traj_number}.csv'
         site_indices_file_path = self.src_path / site_indices_dir_name / site_indices_file_name
-        shell_indices_dict = {}
-        site_indices_dict = {}
-        with site_indices_file_path.open('r') as site_indices_file:
-            for line in site_indices_file:
-                split_elements = re.split(',|\n', line)
-                shell_index = int(split_elements[3])
-                site_index = int(split_elements[0])
-                site_indices_dict[site_index] = shell_index
-                if shell_index in shell_indices_dict:
-                    shell_indices_dict[shell_index].append(site_index)
-                else:
-                    shell_indices_dict[shell_index] = [site_index]
-                
-        num_shells = len(shell_indices_dict) - 1
-        probe_indices = []
-        site_population_list = []
-        for shell_index in range(num_shells+1):
-            if shell_index == num_shells + 1:
-                probe_indices.append(sorted(
-                    [item
-                     for sublist in shell_indices_dict[num_shells+1:]
-                     for item in sublist]))
-            else:
-                probe_indices.append(sorted(
-                    [item for item in shell_indices_dict[shell_index]]))
-            site_population_list.append(
-                                    [0] * len(probe_indices[shell_index]))
+        return self.get_cached_data(
+                    ('site_indices', traj_number),
+                    partial(self.load_text_data, site_indices_file_path,
+                            delimiter=','))
 
-        traj_res_time_pool = []
-        occupancy_dir_name = 'occupancy_data'
-        occupancy_file_name = f'occupancy_{traj_number}.dat'
-        occupancy_file_path = self.src_path / occupancy_dir_name / occupancy_file_name
-        with occupancy_file_path.open('r') as occupancy_file:
-            for line_index, line in enumerate(occupancy_file):
-                site_indices = [int(site_index) for site_index in line.strip().split()]
-                if line_index == 0:
-                    num_species = len(site_indices)
-                    species_wise_res_count = [0] * num_species
-                if res_time:
-                    for species_index, site_index in enumerate(site_indices):
-                        shell_index = site_indices_dict[site_index]
-                        if shell_index <= barrier_shell_index:
-                            species_wise_res_count[species_index] += 1
-                        else:
-                            if species_wise_res_count[species_index] != 0:
-                                traj_res_time_pool.append(species_wise_res_count[species_index])
-                                species_wise_res_count[species_index] = 0
-                for shell_index in range(num_shells+1):
-                    for site_index in site_indices:
-                        if site_index in probe_indices[shell_index]:
-                            list_index = probe_indices[shell_index].index(site_index)
-                            site_population_list[shell_index][list_index] += 1
-                            break
-        num_kmc_steps = line_index
+    def get_site_lookup_tables(self, site_indices_data, num_lookup_sites):
+        """Returns shell-wise probe site indices and dense lookup tables
+        mapping every site index to its shell index and population slot"""
+        site_indices = site_indices_data[:, 0]
+        shell_indices = site_indices_data[:, 3]
+        num_shells = len(np.unique(shell_indices)) - 1
+        probe_mask = (shell_indices >= 0) & (shell_indices <= num_shells)
+        probe_order = np.lexsort((site_indices[probe_mask],
+                                  shell_indices[probe_mask]))
+        probe_site_indices = site_indices[probe_mask][probe_order]
+        probe_shell_indices = shell_indices[probe_mask][probe_order]
+        shell_offsets = np.append(0, np.cumsum(
+                np.bincount(probe_shell_indices, minlength=num_shells+1)))
+        probe_indices = np.split(probe_site_indices, shell_offsets[1:-1])
+
+        # sites absent from the site indices table map to -1
+        site_shell_lookup = np.full(num_lookup_sites, -1, dtype=int)
+        site_shell_lookup[probe_site_indices] = probe_shell_indices
+        site_slot_lookup = np.full(num_lookup_sites, -1, dtype=int)
+        site_slot_lookup[probe_site_indices] = np.arange(
+                                                    len(probe_site_indices))
+        return (num_shells, probe_indices, shell_offsets, site_shell_lookup,
+                site_slot_lookup)
+
+    def read_trajectory_data(self, traj_number, res_time, barrier_shell_index):
+        site_indices_data = self.read_site_indices_data(traj_number)
+        occupancy_data = self.read_occupancy_data(traj_number)
+        num_lookup_sites = max(site_indices_data[:, 0].max(),
+                               occupancy_data.max()) + 1
+        (num_shells, probe_indices, shell_offsets, site_shell_lookup,
+         site_slot_lookup) = self.get_cached_data(
+                    ('site_lookup_tables', traj_number),
+                    partial(self.get_site_lookup_tables, site_indices_data,
+                            num_lookup_sites))
+        occupant_shell_indices = site_shell_lookup[occupancy_data]
+        num_species = occupancy_data.shape[1]
+
+        if res_time:
+            missing_site_indices = np.unique(
+                        occupancy_data[occupant_shell_indices < 0])
+            if len(missing_site_indices):
+                raise KeyError(f'Occupied sites {missing_site_indices.tolist()} '
+                               f'are absent from site_indices_{traj_number}.csv')
+            traj_res_time_pool = self.get_residence_lengths(
+                        occupant_shell_indices <= barrier_shell_index)
+        else:
+            traj_res_time_pool = np.zeros(0, dtype=int)
+
+        # only the first species residing in a shell at a given step
+        # contributes to the population of that shell
+        first_occupant_mask = occupant_shell_indices >= 0
+        for species_index in range(1, num_species):
+            first_occupant_mask[:, species_index] &= np.all(
+                        occupant_shell_indices[:, :species_index]
+                        != occupant_shell_indices[:, species_index, None],
+                        axis=1)
+        site_population = np.bincount(
+                        site_slot_lookup[occupancy_data[first_occupant_mask]],
+                        minlength=shell_offsets[-1])
+        site_population_list = np.split(site_population, shell_offsets[1:-1])
+        num_kmc_steps = len(occupancy_data) - 1
         return (num_shells, probe_indices, site_population_list,
                 traj_res_time_pool, num_kmc_steps)
 
+    def get_residence_lengths(self, residence_mask):
+        """Returns lengths of all residence runs of every species that end
+        within the trajectory, given the (steps x species) residence mask"""
+        (num_steps, num_species) = residence_mask.shape
+        padded_mask = np.zeros((num_species, num_steps + 2), dtype=np.int8)
+        padded_mask[:, 1:-1] = residence_mask.T
+        run_edges = np.diff(padded_mask, axis=1).ravel()
+        run_starts = np.flatnonzero(run_edges == 1)
+        run_ends = np.flatnonzero(run_edges == -1)
+        # discard runs still in progress at the end of the trajectory
+        completed_runs = (run_ends % (num_steps + 1)) != num_steps
+        residence_lengths = (run_ends - run_starts)[completed_runs]
+        return residence_lengths
+
     def read_occupancy_data(self, traj_number):
         occupancy_dir_name = 'occupancy_data'
         occupancy_file_name = f'occupancy_{traj_number}.dat'
         occupancy_file_path = self.src_path / occupancy_dir_name / occupancy_file_name
-        num_kmc_steps = 0
-        with occupancy_file_path.open('r') as occupancy_file:
-            for index, line in enumerate(occupancy_file):
-                if line.strip():
-                    if index == 0:
-                        num_carriers = len(line.strip().split())
-                    num_kmc_steps += 1
-        occupancy_data = np.zeros((num_kmc_steps, num_carriers), int)
-        with occupancy_file_path.open('r') as occupancy_file:
-            for index, line in enumerate(occupancy_file):
-                str_site_indices = line.strip().split()
-                occupancy_data[index, :] = [int(str_site_index) for str_site_index in str_site_indices]
-        return occupancy_data
-
-    def generate_site_wise_occpancy(self, num_shells, probe_indices,
-                                    site_population_list, traj_number):
+        return self.get_cached_data(('occupancy', traj_number),
+                                    partial(self.load_text_data,
+                                            occupancy_file_path))
+
+    def get_binned_site_population(self, site_population, num_site_bins,
+                                   site_bin_statistic):
+        """Returns site populations reduced to at most num_site_bins
+        contiguous bins using either the max or the mean of each bin"""
+        num_sites = len(site_population)
+        if num_site_bins is None or num_sites <= num_site_bins:
+            return site_population
+        bin_starts = np.arange(num_site_bins) * num_sites // num_site_bins
+        if site_bin_statistic == 'mean':
+            bin_sizes = np.diff(np.append(bin_starts, num_sites))
+            return np.add.reduceat(site_population, bin_starts) / bin_sizes
+        return np.maximum.reduceat(site_population, bin_starts)
+
+    def generate_site_wise_occpancy(self, num_shells, site_population_list,
+                                    traj_number, num_site_bins=None):
         plt.switch_backend('Agg')
         fig = plt.figure()
         plt.title('Site-wise occupancy')
@@ -150,10 +345,17 @@ class Occupancy(object):
                 ax = plt.subplot(gs[row_index, :])
             else:
                 ax = plt.subplot(gs[row_index, col_index])
-            length = len(probe_indices[shell_index])
-            ax.bar(range(num_data, num_data+length),
-                   site_population_list[shell_index],
-                   color=self.color_list[shell_index % self.num_colors])
+            length = len(site_population_list[shell_index])
+            color = self.color_list[shell_index % self.num_colors]
+            if num_site_bins is None:
+                ax.bar(range(num_data, num_data+length),
+                       site_population_list[shell_index], color=color)
+            elif length:
+                # a single filled step polygon instead of one patch per site
+                ax.fill_between(np.arange(num_data, num_data+length+1),
+                                np.append(site_population_list[shell_index],
+                                          site_population_list[shell_index][-1]),
+                                step='post', color=color, linewidth=0)
             ax.set_ylabel(f'{shell_index}')
             ax.set_xticks([])
             ax.set_yticks([])
@@ -163,28 +365,52 @@ class Occupancy(object):
         plt.savefig(str(figure_path))
         return None
 
-    def generate_shell_wise_occupancy(self, num_shells, site_population_repo,
-                                      n_traj):
+    def generate_combined_site_wise_occupancy(self, num_shells,
+                                              binned_population_repo, n_traj):
+        """Renders site-wise occupancy of all trajectories as a single
+        heatmap with one row per trajectory"""
+        plt.switch_backend('Agg')
+        fig = plt.figure()
+        plt.title('Site-wise occupancy')
+        ax = fig.add_subplot(111)
+        shell_lengths = [len(binned_population)
+                         for binned_population in binned_population_repo[0]]
+        shell_offsets = np.cumsum(shell_lengths)
+        occupancy_map = np.vstack([np.concatenate(binned_population_list)
+                                   for binned_population_list
+                                   in binned_population_repo])
+        image = ax.imshow(occupancy_map, aspect='auto',
+                          interpolation='nearest', origin='lower',
+                          extent=(0, shell_offsets[-1], 0.5, n_traj + 0.5))
+        for shell_offset in shell_offsets[:-1]:
+            ax.axvline(shell_offset, color='white', linewidth=0.5)
+        ax.set_xticks(shell_offsets - np.asarray(shell_lengths) / 2)
+        ax.set_xticklabels([str(index) for index in range(num_shells+1)])
+        ax.set_xlabel('Shell Number')
+        ax.set_ylabel('Trajectory Number')
+        fig.colorbar(image, ax=ax, label='Site population')
+        figure_name = f'site-wise_occupancy_{n_traj}traj.png'
+        figure_path = self.src_path / figure_name
+        plt.tight_layout()
+        plt.savefig(str(figure_path))
+        datafile_name = f'site-wise_occupancy_{n_traj}traj.txt'
+        np.savetxt(datafile_name, occupancy_map)
+        return None
+
+    def generate_shell_wise_occupancy(self, num_shells, fraction_sum,
+                                      fraction_sq_sum, n_traj):
         plt.switch_backend('Agg')
         fig = plt.figure()
         plt.title('Shell-wise fractional occupancy')
         ax = fig.add_subplot(111)
-        fractional_occupancy_list = np.zeros((n_traj, num_shells+1))
-        for traj_index, site_population_list in enumerate(site_population_repo):
-            num_steps_sampled = sum([sum(site_population_list[shell_index]) for shell_index in range(len(site_population_list))])
-            for shell_index in range(num_shells+1):
-                if shell_index < len(site_population_list) - 1:
-                    fraction_value = np.sum(site_population_list[shell_index]) / num_steps_sampled
-                else:
-                    fraction_value = 0
-                fractional_occupancy_list[traj_index, shell_index] = fraction_value
-
-        fraction_value_array = np.zeros((num_shells+1, 2))
+        mean_fraction_values = fraction_sum / n_traj
+        std_fraction_values = np.sqrt(np.maximum(
+                fraction_sq_sum / n_traj - mean_fraction_values**2, 0))
+        fraction_value_array = np.hstack((mean_fraction_values[:, None],
+                                          std_fraction_values[:, None]))
         for shell_index in range(num_shells+1):
-            mean_fraction_value = np.mean(fractional_occupancy_list[:, shell_index])
-            fraction_value_array[shell_index, 0] = mean_fraction_value
-            std_fraction_value = np.std(fractional_occupancy_list[:, shell_index])
-            fraction_value_array[shell_index, 1] = std_fraction_value
+            mean_fraction_value = mean_fraction_values[shell_index]
+            std_fraction_value = std_fraction_values[shell_index]
             ax.bar(shell_index, mean_fraction_value, color='#607c8e')
             ax.errorbar(shell_index, mean_fraction_value, color='black',
                         yerr=std_fraction_value, capsize=3)
@@ -200,32 +426,23 @@ class Occupancy(object):
         np.savetxt(datafile_name, fraction_value_array)
         return None
 
-    def generate_res_time_distribution(self, res_time_pool, n_traj):
+    def generate_res_time_distribution(self, res_time_freq_sum,
+                                       res_time_freq_sq_sum,
+                                       mean_residence_length_sum,
+                                       mean_residence_length_sq_sum, n_traj):
         plt.switch_backend('Agg')
         fig = plt.figure()
         plt.title('Residence length distribution in the doping region')
         ax1 = fig.add_subplot(111)
-        cumulative_res_time_pool = [res_time
-                                    for traj_res_time_pool in res_time_pool
-                                    for res_time in traj_res_time_pool]
-        min_res_time = min(cumulative_res_time_pool)
-        max_res_time = max(cumulative_res_time_pool)
-        num_bins = max_res_time - min_res_time + 1
+        observed_res_times = np.flatnonzero(res_time_freq_sum)
+        min_res_time = observed_res_times.min()
+        max_res_time = observed_res_times.max()
         bin_edges = np.arange(min_res_time-1, max_res_time+1) + 0.5
-        cumulative_pop, _ = np.histogram(cumulative_res_time_pool, bin_edges)
         bin_centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
-        traj_freq = []
-        mean_residence_length_pool = []
-        for traj_res_time_pool in res_time_pool:
-            i_traj_freq, _ = np.histogram(traj_res_time_pool, bin_edges)
-            i_total_freq = sum(i_traj_freq)
-            i_prob_freq = i_traj_freq / i_total_freq
-            i_mean_residence_length = np.inner(bin_centers, i_prob_freq)
-            mean_residence_length_pool.append(i_mean_residence_length)
-            traj_freq.append(i_traj_freq)
-        traj_freq = np.asarray(traj_freq)
-        mean_freq = np.mean(traj_freq, axis=0)
-        std_pop = np.std(traj_freq, axis=0)
+        mean_freq = res_time_freq_sum[min_res_time:max_res_time+1] / n_traj
+        std_pop = np.sqrt(np.maximum(
+                res_time_freq_sq_sum[min_res_time:max_res_time+1] / n_traj
+                - mean_freq**2, 0))
         plt.plot(bin_centers, mean_freq, 'o-', color='black',
                 mfc=self.color_list[1], mec='black')
         plt.errorbar(bin_centers, mean_freq, yerr=std_pop, fmt='o', capsize=3,
@@ -234,8 +451,10 @@ class Occupancy(object):
         plt.yscale('linear')
         xmin, xmax = plt.xlim()
         ymin, ymax = plt.ylim()
-        mean_residence_length = np.mean(mean_residence_length_pool)
-        std_mean_residence_length = np.std(mean_residence_length_pool)
+        mean_residence_length = mean_residence_length_sum / n_traj
+        std_mean_residence_length = np.sqrt(max(
+                mean_residence_length_sq_sum / n_traj
+                - mean_residence_length**2, 0))
         plt.plot([mean_residence_length] * 2, [ymin, ymax], '--',
                  color=self.color_list[2])
         plt.ylim([ymin, ymax])
@@ -305,37 +524,49 @@ class Occupancy(object):
             step_limits.append(old_index + step_system_size[ld])
             old_index += step_system_size[ld]
         step_limits = np.asarray(step_limits)
+        # a site belongs to the step whose limits satisfy
+        # step_limits[i] < cell index <= step_limits[i+1], wrapping around
+        site_step_map = get_site_segment_map(self.src_path, system_size, ld,
+                                             step_limits,
+                                             num_elements_per_unit_cell,
+                                             closed='right')
         step_res_count = np.zeros((n_traj, num_steps), int)
         if num_steps > 2:
             up_transition_record = np.zeros((n_traj, num_steps), int)
             down_transition_record = np.zeros((n_traj, num_steps), int)
         else:
             transition_record = np.zeros((n_traj), int)
+        # (from step, to step) transition counts
+        transition_matrix = np.zeros((n_traj, num_steps, num_steps), int)
         for traj_number in range(1, n_traj+1):
-            traj_step_res_count = np.zeros(num_steps, int)
             occupancy_data = self.read_occupancy_data(traj_number)
-            old_kmc_stepwise_step_res_count = np.zeros(num_steps, int)
-            for kmc_step_index, kmc_stepwise_occupancy_data in enumerate(occupancy_data):
-                new_kmc_stepwise_step_res_count = np.zeros(num_steps, int)
-                for site_index in kmc_stepwise_occupancy_data:
-                    cell_indices = self.get_cell_indices(system_size, site_index,
-                                                         num_elements_per_unit_cell)
-                    site_step_index = sum(step_limits < cell_indices[ld]) - 1
-                    new_kmc_stepwise_step_res_count[site_step_index] += 1
-                if kmc_step_index != 0 and not np.array_equal(old_kmc_stepwise_step_res_count, new_kmc_stepwise_step_res_count):
-                    if num_steps > 2:
-                        step_transition = new_kmc_stepwise_step_res_count - old_kmc_stepwise_step_res_count
-                        initial_step_index = np.where(step_transition == -1)[0][0]
-                        final_step_index = np.where(step_transition == 1)[0][0]
-                        if final_step_index == initial_step_index + 1 or final_step_index == initial_step_index - num_steps + 1:
-                            up_transition_record[traj_number-1][initial_step_index] += 1
-                        else:
-                            down_transition_record[traj_number-1][initial_step_index] += 1
-                    else:
-                        transition_record[traj_number-1] += 1
-                old_kmc_stepwise_step_res_count = np.copy(new_kmc_stepwise_step_res_count) 
-                traj_step_res_count += new_kmc_stepwise_step_res_count
-            step_res_count[traj_number-1] = traj_step_res_count
+            # step indices of all carriers at every kmc step
+            step_indices = site_step_map[occupancy_data]
+            step_res_count[traj_number-1] = np.bincount(step_indices.ravel(),
+                                                        minlength=num_steps)
+
+            # detect transitions between steps from consecutive kmc steps
+            (transition_kmc_steps, transition_carriers) = np.nonzero(
+                                        np.diff(step_indices, axis=0))
+            initial_step_indices = step_indices[transition_kmc_steps,
+                                                transition_carriers]
+            final_step_indices = step_indices[transition_kmc_steps + 1,
+                                              transition_carriers]
+            transition_matrix[traj_number-1] = np.bincount(
+                        initial_step_indices * num_steps + final_step_indices,
+                        minlength=num_steps**2).reshape(num_steps, num_steps)
+            if num_steps > 2:
+                up_transitions = (
+                    (final_step_indices == initial_step_indices + 1)
+                    | (final_step_indices == initial_step_indices - num_steps + 1))
+                up_transition_record[traj_number-1] = np.bincount(
+                                    initial_step_indices[up_transitions],
+                                    minlength=num_steps)
+                down_transition_record[traj_number-1] = np.bincount(
+                                    initial_step_indices[~up_transitions],
+                                    minlength=num_steps)
+            else:
+                transition_record[traj_number-1] = len(initial_step_indices)
         mean_step_res_count = np.mean(step_res_count, axis=0)
         std_step_res_count = np.std(step_res_count, axis=0)
         if num_steps > 2:
@@ -355,6 +586,12 @@ class Occupancy(object):
             transition_record_file_name = 'stepwise_transition_record.txt'
             transition_record_file_path = self.src_path / transition_record_file_name
             np.savetxt(transition_record_file_path, transition_record)
+        mean_transition_matrix = np.mean(transition_matrix, axis=0)
+        std_transition_matrix = np.std(transition_matrix, axis=0)
+        transition_matrix_file_name = 'stepwise_transition_matrix.txt'
+        transition_matrix_file_path = self.src_path / transition_matrix_file_name
+        np.savetxt(transition_matrix_file_path,
+                   transition_matrix.reshape(n_traj, num_steps**2))
         stat_decimals = 3
         log_report = []
         log_report.append(f'Stepwise mean occupancy of electrons is: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in mean_step_res_count) + ']\n')
@@ -365,8 +602,10 @@ class Occupancy(object):
             log_report.append(f'Standard deviation values of up-transition record: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in std_up_transition_record) + ']\n')
             log_report.append(f'Standard deviation values of down-transition record: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in std_down_transition_record) + ']\n')
         else:
-            log_report.append(f'Mean values of transition record: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in mean_transition_record) + ']\n')
-            log_report.append(f'Standard deviation values of transition record: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in std_transition_record) + ']\n')
+            log_report.append(f'Mean values of transition record: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in np.atleast_1d(mean_transition_record)) + ']\n')
+            log_report.append(f'Standard deviation values of transition record: [' + ", ".join(f'{val:.{stat_decimals}f}' for val in np.atleast_1d(std_transition_record)) + ']\n')
+        log_report.append(f'Mean values of transition matrix (from step x to step): [' + ", ".join('[' + ", ".join(f'{val:.{stat_decimals}f}' for val in row) + ']' for row in mean_transition_matrix) + ']\n')
+        log_report.append(f'Standard deviation values of transition matrix (from step x to step): [' + ", ".join('[' + ", ".join(f'{val:.{stat_decimals}f}' for val in row) + ']' for row in std_transition_matrix) + ']\n')
         step_res_time_data_file_name = 'stepwise_residence_occupancy'
         step_res_time_data_file_path = self.src_path / (step_res_time_data_file_name + '.txt')
         np.savetxt(step_res_time_data_file_path, step_res_count)
@@ -4,7 +4,36 @@
 
 import os
 
-def generate_parallel_input_files(src_path):
+JOB_ARRAY_MANIFEST_FILE_NAME = 'job_array_manifest.txt'
+TASK_FARM_FILE_NAME = 'task_farm.py'
+
+def write_job_array_manifest(manifest_file_path, job_names, work_dirs):
+    """Writes tab separated (task id, job name, working directory) lines
+    with task ids starting from 1"""
+    with open(manifest_file_path, 'w') as manifest_file:
+        for task_index, (job_name, work_dir) in enumerate(zip(job_names, work_dirs)):
+            manifest_file.write(f'{task_index+1}\t{job_name}\t{work_dir}\n')
+    return None
+
+def get_job_array_task_lines(manifest_file_name=JOB_ARRAY_MANIFEST_FILE_NAME):
+    """Returns shell lines resolving the job name and working directory of
+    an array task from the manifest in the submit directory. The working
+    directory then stands in for SLURM_SUBMIT_DIR"""
+    return ('\n# Resolve job name and working directory of this array task\n'
+            f'task_line=`awk -F\'\\t\' -v task_id=$SLURM_ARRAY_TASK_ID \'$1 == task_id\' "$SLURM_SUBMIT_DIR/{manifest_file_name}"`\n'
+            'job_name=`echo "$task_line" | cut -f2`\n'
+            'work_dir=`echo "$task_line" | cut -f3`\n'
+            'export SLURM_SUBMIT_DIR="$SLURM_SUBMIT_DIR/$work_dir"\n'
+            'cd "$SLURM_SUBMIT_DIR"\n'
+            'echo "SLURM_ARRAY_TASK_ID="$SLURM_ARRAY_TASK_ID\n'
+            'echo "job name = "$job_name\n')
+
+def get_array_directive(num_tasks, array_throttle=None):
+    throttle_term = f'%{array_throttle}' if array_throttle else ''
+    return f'#SBATCH --array=1-{num_tasks}{throttle_term}\n'
+
+def generate_parallel_input_files(src_path, job_array=False, array_throttle=None,
+                                  packed=False, num_tasks=None):
     with open(src_path / 'simulation_parameters.yml') as params_file:
         for line in params_file:
             if 'compute_mode' in line:
@@ -16,6 +45,7 @@ def generate_parallel_input_files(src_path):
     slurm_search_term = "job-name"
     mail_type_search_term = "#SBATCH --mail-type="
     none_term = 'NONE'
+    slurm_file_name = 'slurmscript'
     if compute_mode == 'parallel':
         for traj_index in range(n_traj):
             traj_dir_path = src_path / f'traj{traj_index+1}'
@@ -24,8 +54,18 @@ def generate_parallel_input_files(src_path):
                 dst_file_path = traj_dir_path / file_name
                 os.symlink(src_file_path, dst_file_path)
 
+        if job_array:
+            generate_job_array_slurm_file(src_path, slurm_file_name, n_traj,
+                                          array_throttle)
+            return None
+        if packed:
+            generate_packed_slurm_file(src_path, slurm_file_name, n_traj,
+                                       num_tasks)
+            return None
+
+        for traj_index in range(n_traj):
+            traj_dir_path = src_path / f'traj{traj_index+1}'
             # generate slurm files
-            slurm_file_name = 'slurmscript'
             old_slurm_file_path = src_path / slurm_file_name
             new_slurm_file_path = traj_dir_path / slurm_file_name
             with open(old_slurm_file_path) as old_slurm_file, open(new_slurm_file_path, 'w') as new_slurm_file:
@@ -38,6 +78,86 @@ def generate_parallel_input_files(src_path):
                         new_slurm_file.write(line)
     return None
 
+def generate_job_array_slurm_file(src_path, slurm_file_name, n_traj,
+                                  array_throttle=None):
+    """Writes a single job-array slurm file running every traj directory as
+    one array task, along with the manifest mapping task ids to them"""
+    slurm_search_term = "job-name"
+    output_search_term = "#SBATCH --output="
+    mail_type_search_term = "#SBATCH --mail-type="
+    none_term = 'NONE'
+    old_slurm_file_path = src_path / slurm_file_name
+    new_slurm_file_path = src_path / f'{slurm_file_name}_array'
+    with open(old_slurm_file_path) as old_slurm_file:
+        slurm_lines = old_slurm_file.readlines()
+    if not any(slurm_search_term in line for line in slurm_lines):
+        raise ValueError(f'No {slurm_search_term} directive found in {old_slurm_file_path}')
+    last_directive_index = max(line_index for line_index, line in enumerate(slurm_lines)
+                               if line.startswith('#SBATCH'))
+    with open(new_slurm_file_path, 'w') as new_slurm_file:
+        for line_index, line in enumerate(slurm_lines):
+            if slurm_search_term in line:
+                job_name = line.strip().split('=', 1)[1].strip('"')
+                job_names = [f'{job_name}-traj{traj_index+1}' for traj_index in range(n_traj)]
+                new_slurm_file.write(line)
+                new_slurm_file.write(get_array_directive(n_traj, array_throttle))
+            elif output_search_term in line:
+                # each task writes its output within its own traj directory
+                output_file_name = line.strip()[len(output_search_term):]
+                new_slurm_file.write(f'{output_search_term}traj%a/{output_file_name}\n')
+            elif mail_type_search_term in line:
+                new_slurm_file.write(f'{mail_type_search_term}{none_term}\n')
+            else:
+                new_slurm_file.write(line)
+            if line_index == last_directive_index:
+                new_slurm_file.write(get_job_array_task_lines())
+    work_dirs = [f'traj{traj_index+1}' for traj_index in range(n_traj)]
+    write_job_array_manifest(src_path / JOB_ARRAY_MANIFEST_FILE_NAME, job_names,
+                             work_dirs)
+    return None
+
+def generate_packed_slurm_file(src_path, slurm_file_name, n_traj, num_tasks=None):
+    """Writes a single slurm file running every traj directory within one
+    allocation through a task-farm driver, which keeps up to tasks-per-node
+    trajectories running at once. The rest of the slurm file is kept as is
+    apart from copying Run.py outputs back from the scratch directory, as
+    every trajectory writes its outputs within its own traj directory"""
+    tasks_per_node_search_term = "#SBATCH --tasks-per-node="
+    run_search_term = 'srun Run.py'
+    copy_back_search_term = 'cp $SLURMTMPDIR/'
+    old_slurm_file_path = src_path / slurm_file_name
+    new_slurm_file_path = src_path / f'{slurm_file_name}_packed'
+    with open(old_slurm_file_path) as old_slurm_file, open(new_slurm_file_path, 'w') as new_slurm_file:
+        after_run_line = False
+        for line in old_slurm_file:
+            if after_run_line and line.startswith(copy_back_search_term):
+                continue
+            after_run_line = False
+            if tasks_per_node_search_term in line and num_tasks:
+                new_slurm_file.write(f'{tasks_per_node_search_term}{num_tasks}\n')
+            elif run_search_term in line:
+                # traj directories and the driver live in the submit directory
+                new_slurm_file.write('cd "$SLURM_SUBMIT_DIR"\n')
+                new_slurm_file.write(f'./{TASK_FARM_FILE_NAME}\n')
+                after_run_line = True
+            else:
+                new_slurm_file.write(line)
+
+    # generate task-farm driver
+    task_farm_file_path = src_path / TASK_FARM_FILE_NAME
+    work_dirs = [f'traj{traj_index+1}' for traj_index in range(n_traj)]
+    with task_farm_file_path.open('w') as task_farm_file:
+        task_farm_file.write(
+            "#!/usr/bin/env python\n\n"
+            "from pathlib import Path\n"
+            "import sys\n\n"
+            "from pycdscripts.task_farm import run_task_farm\n\n"
+            "src_path = Path(__file__).resolve().parent\n"
+            f"work_dirs = {work_dirs}\n"
+            "sys.exit(1 if run_task_farm(src_path, work_dirs, ['./Run.py']) else 0)\n")
+    task_farm_file_path.chmod(0o755)
+    return None
+
 def generate_slurm_msd_script(src_path):
     old_slurm_file_path = src_path / 'slurmscript'
     new_slurm_file_path = src_path / 'slurmscript_msd'
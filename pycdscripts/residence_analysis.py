@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 import yaml
 
 from PyCT import constants
+from pycdscripts.segment_map import get_segment_bin_edges, get_site_segment_map
 
 
 class Residence(object):
@@ -98,24 +99,14 @@ class Residence(object):
         np.save(self.src_path / f'shell_wise_relative_residence_data.npy', shell_wise_relative_residence_data)
         return None
 
-    def get_unit_cell_indices(self, site_indices):
-        unit_cell_indices_shape = np.append(self.ndim, site_indices.shape)
-        unit_cell_indices = np.zeros(unit_cell_indices_shape, int)
-        unit_cell_element_indices = site_indices % self.total_elements_per_unit_cell
-        total_filled_unit_cells = ((site_indices - unit_cell_element_indices)
-                                   // self.total_elements_per_unit_cell)
-        for index in range(self.ndim):
-            unit_cell_indices[index] = total_filled_unit_cells / self.system_size[index+1:].prod()
-            total_filled_unit_cells -= unit_cell_indices[index] * self.system_size[index+1:].prod()
-        return unit_cell_indices
-
     def get_layer_wise_site_indices(self, traj_number, interface, layer_length_ratio, gradient_direction):
         site_indices_data = np.load(f'{self.src_path}/traj{traj_number}/site_indices.npy')[()]
         
         num_layers = len(layer_length_ratio)
         layer_wise_shell_site_indices = [np.empty(shape=(num_layers, map_index_num_shells+2), dtype=object) for map_index_num_shells in self.num_shells]
-        bin_edges = np.cumsum(layer_length_ratio) * self.system_size[gradient_direction] / np.sum(layer_length_ratio)
-        bin_edges = np.append(np.array([0]), bin_edges)
+        bin_edges = get_segment_bin_edges(self.system_size, gradient_direction, layer_length_ratio)
+        site_layer_map = get_site_segment_map(self.src_path, self.system_size, gradient_direction,
+                                              bin_edges, self.total_elements_per_unit_cell)
         for map_index, map_index_num_shells in enumerate(self.num_shells):
             for shell_index in range(map_index_num_shells+2):
                 if shell_index == map_index_num_shells + 1:
@@ -123,14 +114,14 @@ class Residence(object):
                 else:
                     shell_wise_site_indices_data = site_indices_data[(site_indices_data[:, 1] == map_index) & (site_indices_data[:, 3] == shell_index)][:, 0]
                 if interface == 'flat':
-                    unit_cell_indices = self.get_unit_cell_indices(shell_wise_site_indices_data)[gradient_direction]
+                    site_layer_indices = site_layer_map[shell_wise_site_indices_data]
                     for layer_index in range(num_layers):
-                        layer_wise_shell_site_indices[map_index][layer_index, shell_index] = shell_wise_site_indices_data[(unit_cell_indices >= bin_edges[layer_index]) & (unit_cell_indices < bin_edges[layer_index+1])]
+                        layer_wise_shell_site_indices[map_index][layer_index, shell_index] = shell_wise_site_indices_data[site_layer_indices == layer_index]
                 elif interface =='bumpy':
                     if shell_index == 0 or shell_index == map_index_num_shells+1:
-                        unit_cell_indices = self.get_unit_cell_indices(shell_wise_site_indices_data)[gradient_direction]
+                        site_layer_indices = site_layer_map[shell_wise_site_indices_data]
                         for layer_index in range(num_layers):
-                            layer_wise_shell_site_indices[map_index][layer_index, shell_index] = shell_wise_site_indices_data[(unit_cell_indices >= bin_edges[layer_index]) & (unit_cell_indices < bin_edges[layer_index+1])]
+                            layer_wise_shell_site_indices[map_index][layer_index, shell_index] = shell_wise_site_indices_data[site_layer_indices == layer_index]
                     else:
                         dopant_site_shell_index = 0
                         for layer_index in range(num_layers):
@@ -0,0 +1,113 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import hashlib
+import os
+
+import numpy as np
+import yaml
+
+# site segment maps already loaded in this process, keyed by map signature
+site_segment_map_cache = {}
+
+
+def get_segment_bin_edges(system_size, ld, length_ratio):
+    """Returns segment boundaries in unit cells along the gradient direction
+    :param system_size:
+    :param ld:
+    :param length_ratio:
+    :return:
+    """
+    return np.append(0, np.cumsum(length_ratio) * system_size[ld]
+                        / np.sum(length_ratio))
+
+def build_site_segment_map(system_size, ld, bin_edges,
+                           total_elements_per_unit_cell, closed='left'):
+    """Returns the segment index of every site index in the supercell from
+    the unit cell index c of the site along ld. With closed='left' segment i
+    holds bin_edges[i] <= c < bin_edges[i+1], the last edge being inclusive
+    and sites outside all segments mapping to -1. With closed='right'
+    segment i holds bin_edges[i] < c <= bin_edges[i+1], wrapping cells
+    outside all segments around the segment indices
+    :param system_size:
+    :param ld:
+    :param bin_edges:
+    :param total_elements_per_unit_cell:
+    :param closed:
+    :return:
+    """
+    system_size = np.asarray(system_size)
+    bin_edges = np.asarray(bin_edges)
+    num_segments = len(bin_edges) - 1
+    num_sites = system_size.prod() * total_elements_per_unit_cell
+    total_filled_unit_cells = np.arange(num_sites) // total_elements_per_unit_cell
+    gradient_cell_indices = ((total_filled_unit_cells // system_size[ld+1:].prod())
+                             % system_size[ld])
+    if closed == 'right':
+        return (np.searchsorted(bin_edges, gradient_cell_indices)
+                - 1) % num_segments
+    site_segment_map = np.searchsorted(bin_edges, gradient_cell_indices,
+                                       side='right') - 1
+    site_segment_map[gradient_cell_indices == bin_edges[-1]] = num_segments - 1
+    site_segment_map[site_segment_map >= num_segments] = -1
+    return site_segment_map
+
+def get_site_segment_map(src_path, system_size, ld, bin_edges,
+                         total_elements_per_unit_cell, closed='left'):
+    """Returns the site segment map of a simulation directory, building it
+    once and caching it to a site_segment_map_<signature hash>.npy file
+    :param src_path:
+    :param system_size:
+    :param ld:
+    :param bin_edges:
+    :param total_elements_per_unit_cell:
+    :param closed:
+    :return:
+    """
+    map_signature = (f'{np.asarray(system_size).tolist()} {ld} '
+                     f'{np.asarray(bin_edges, float).tolist()} '
+                     f'{total_elements_per_unit_cell} {closed}')
+    map_hash = hashlib.md5(map_signature.encode()).hexdigest()[:12]
+    map_file_path = src_path / f'site_segment_map_{map_hash}.npy'
+    stat_file_path = src_path / f'site_segment_map_{map_hash}.npy.stat'
+    cache_key = (str(src_path), map_signature)
+    if cache_key in site_segment_map_cache:
+        return site_segment_map_cache[cache_key]
+    if map_file_path.exists() and stat_file_path.exists():
+        with stat_file_path.open('r') as stat_file:
+            if stat_file.read().strip() == map_signature:
+                site_segment_map = np.load(map_file_path)
+                site_segment_map_cache[cache_key] = site_segment_map
+                return site_segment_map
+
+    site_segment_map = build_site_segment_map(system_size, ld, bin_edges,
+                                              total_elements_per_unit_cell,
+                                              closed)
+    # write to process-private files first so that concurrent analyses never
+    # read a partially written map
+    tmp_suffix = f'.{os.getpid()}.tmp'
+    with open(f'{map_file_path}{tmp_suffix}', 'wb') as map_file:
+        np.save(map_file, site_segment_map)
+    with open(f'{stat_file_path}{tmp_suffix}', 'w') as stat_file:
+        stat_file.write(map_signature)
+    os.replace(f'{map_file_path}{tmp_suffix}', map_file_path)
+    os.replace(f'{stat_file_path}{tmp_suffix}', stat_file_path)
+    site_segment_map_cache[cache_key] = site_segment_map
+    return site_segment_map
+
+def read_gradient_params(src_path):
+    """Returns system size, gradient direction and step length ratio of the
+    doping gradient from simulation_parameters.yml
+    :param src_path:
+    :return: (system_size, ld, step_length_ratio):
+    """
+    sim_param_file_path = src_path / 'simulation_parameters.yml'
+    with open(sim_param_file_path, 'r') as stream:
+        sim_params = yaml.safe_load(stream)
+    doping_params = sim_params['doping']
+    # NOTE: Assuming identical gradient direction and step_length_ratio for all existing dopant element types
+    sample_existing_map_index = (np.asarray(doping_params['num_dopants']) > 0).tolist().index(True)
+    gradient_params = doping_params['gradient'][sample_existing_map_index]
+    return (np.asarray(sim_params['system_size']), gradient_params['ld'],
+            gradient_params['step_length_ratio'])
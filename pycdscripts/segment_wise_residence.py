@@ -2,96 +2,119 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from functools import partial
+from multiprocessing import Pool
+
 import numpy as np
 import matplotlib.pyplot as plt
 from PyCT.constants import AUTIME2NS
+from pycdscripts.segment_map import get_site_segment_map
 
 
-def read_occupancy(src_path, n_traj):
-    """Reads the occupancy data from traj-level directories and return a 
-       dictionary of trajectory-wise occupancy data, each as a numpy array
+def load_trajectory_data(src_path, traj_number):
+    """Returns memory-mapped occupancy data and time data in atomic units of
+    a single trajectory
     :param src_path:
-    :param n_traj:
-    :return: occupancy_data:
+    :param traj_number:
+    :return: (occupancy_data, time_data):
     """
-    occupancy_file_name = 'occupancy.npy'
-    occupancy_data = {}
-    for traj_index in range(n_traj):
-        traj_dir_path = src_path / f'traj{traj_index+1}'
-        occupancy_data[traj_index+1] = np.load(traj_dir_path / occupancy_file_name)
-    return occupancy_data
+    traj_dir_path = src_path / f'traj{traj_number}'
+    occupancy_data = np.load(traj_dir_path / 'occupancy.npy', mmap_mode='r')
+    time_data = np.load(traj_dir_path / 'time_data.npy', mmap_mode='r')
+    return (occupancy_data, time_data)
 
-def read_time_data(src_path, n_traj):
-    """Reads the occupancy data from traj-level directories and return a 
-       dictionary of trajectory-wise occupancy data, each as a numpy array
-    :param src_path:
-    :param n_traj:
-    :return: occupancy_data:
+def get_segment_wise_residence(segment_indices, time_step_data,
+                               num_segments):
+    """Returns time-weighted (species, segment) residence from segment
+    indices of all species at every state
+    :param segment_indices:
+    :param time_step_data:
+    :param num_segments:
+    :return:
     """
-    time_data_file_name = 'time_data.npy'
-    time_data = {}
-    for traj_index in range(n_traj):
-        traj_dir_path = src_path / f'traj{traj_index+1}'
-        time_data[traj_index+1] = np.load(traj_dir_path / time_data_file_name) * AUTIME2NS
-    return time_data
+    num_species = segment_indices.shape[1]
+    keys = np.arange(num_species) * num_segments + segment_indices
+    weights = np.broadcast_to(time_step_data[:, None], keys.shape)
+    # states outside all segments do not contribute
+    in_range = segment_indices >= 0
+    segment_wise_residence = np.bincount(keys[in_range],
+                                         weights=weights[in_range],
+                                         minlength=num_species * num_segments)
+    return segment_wise_residence.reshape(num_species, num_segments)
 
-def get_unit_cell_indices(system_size, total_elements_per_unit_cell, n_traj,
-                          occupancy_data):
-    """Returns the unit cell indices of the element
+def get_traj_segment_wise_residence(traj_number, src_path, system_size,
+                                    total_elements_per_unit_cell, gradient_ld,
+                                    bin_edges, chunk_size=2**20):
+    """Returns the (species, segment) residence of a single trajectory,
+    looking up segments of its memory-mapped states in chunks of chunk_size
+    :param traj_number:
+    :param src_path:
     :param system_size:
     :param total_elements_per_unit_cell:
-    :param system_element_index:
+    :param gradient_ld:
+    :param bin_edges:
+    :param chunk_size:
     :return:
     """
-    unit_cell_index_data = {}
-    for traj_index in range(n_traj):
-        traj_occupancy_data = occupancy_data[traj_index+1]
-        (num_states, num_species) = traj_occupancy_data.shape
-        traj_unit_cell_indices = np.zeros((num_states, num_species, 3), int)
-        unit_cell_element_indices = traj_occupancy_data % total_elements_per_unit_cell
-        total_filled_unit_cells = ((traj_occupancy_data - unit_cell_element_indices)
-                                   // total_elements_per_unit_cell)
-        for index in range(3):
-            traj_unit_cell_indices[:, :, index] = total_filled_unit_cells / system_size[index+1:].prod()
-            total_filled_unit_cells -= traj_unit_cell_indices[:, :, index] * system_size[index+1:].prod()
-        unit_cell_index_data[traj_index+1] = traj_unit_cell_indices
-    return unit_cell_index_data
+    site_segment_map = get_site_segment_map(
+            src_path, system_size, gradient_ld, bin_edges,
+            total_elements_per_unit_cell)
+    num_segments = len(bin_edges) - 1
+    (occupancy_data, time_data) = load_trajectory_data(src_path, traj_number)
+    num_species = occupancy_data.shape[1]
+    traj_segment_wise_residence = np.zeros((num_species, num_segments))
+    for chunk_start in range(0, len(time_data) - 1, chunk_size):
+        chunk_slice = slice(chunk_start, chunk_start + chunk_size)
+        # time steps in ns of the states within the chunk
+        time_step_data = np.diff(
+                time_data[chunk_start:chunk_start + chunk_size + 1]) * AUTIME2NS
+        segment_indices = site_segment_map[occupancy_data[:-1][chunk_slice]]
+        traj_segment_wise_residence += get_segment_wise_residence(
+                segment_indices, time_step_data, num_segments)
+    return traj_segment_wise_residence
 
 def compute_segment_wise_residence(src_path, system_size, total_elements_per_unit_cell,
                                    n_traj, gradient_ld, segment_length_ratio,
                                    segmentwise_num_dopants,
-                                   num_acceptor_sites_per_unit_cell):
+                                   num_acceptor_sites_per_unit_cell,
+                                   n_workers=1):
     """Returns the segment wise residence of charge carriers
     :param src_path:
     :param system_size:
     :param n_traj:
     :param gradient_ld:
     :param segment_length_ratio:
+    :param n_workers:
     :return:
     """
-    occupancy_data = read_occupancy(src_path, n_traj)
-    num_species = occupancy_data[1].shape[1]
-    time_data = read_time_data(src_path, n_traj)
-    unit_cell_index_data = get_unit_cell_indices(
-            system_size, total_elements_per_unit_cell, n_traj, occupancy_data)
     num_elemental_segments = np.sum(segment_length_ratio)
     elemental_segment_system_size = np.copy(system_size)
     elemental_segment_system_size[gradient_ld] //= num_elemental_segments
     num_segments = len(segment_length_ratio)
     bin_edges = [0]
     segmentwise_doping_level = []
-    species_wise_segment_wise_residence = np.zeros((n_traj, num_species, num_segments))
     for segment_index in range(num_segments):
         segment_system_size = elemental_segment_system_size * segment_length_ratio[segment_index]
         bin_edges.append(bin_edges[-1] + segment_system_size[gradient_ld])
         segmentwise_num_acceptor_sites = segment_system_size.prod() * num_acceptor_sites_per_unit_cell
         segmentwise_doping_level.append(segmentwise_num_dopants[segment_index] / segmentwise_num_acceptor_sites * 100)
-    for traj_index in range(n_traj):
-        trajwise_unit_cell_index_data = unit_cell_index_data[traj_index+1]
-        for species_index in range(num_species):
-            species_wise_segment_wise_residence[traj_index, species_index] = np.histogram(
-                trajwise_unit_cell_index_data[:-1, species_index, gradient_ld],
-                bin_edges, weights=np.diff(time_data[traj_index+1]))[0]
+    # build the shared site segment map before any worker looks it up
+    get_site_segment_map(src_path, system_size, gradient_ld, bin_edges,
+                         total_elements_per_unit_cell)
+    # trajectories are mapped one at a time to bound memory
+    traj_residence = partial(
+            get_traj_segment_wise_residence, src_path=src_path,
+            system_size=system_size,
+            total_elements_per_unit_cell=total_elements_per_unit_cell,
+            gradient_ld=gradient_ld, bin_edges=bin_edges)
+    traj_numbers = range(1, n_traj+1)
+    if n_workers > 1:
+        with Pool(n_workers) as pool:
+            species_wise_segment_wise_residence = np.asarray(
+                                pool.map(traj_residence, traj_numbers))
+    else:
+        species_wise_segment_wise_residence = np.asarray(
+                                list(map(traj_residence, traj_numbers)))
 
     segment_wise_residence = np.mean(species_wise_segment_wise_residence, axis=1)
     mean_segment_wise_residence = np.mean(segment_wise_residence, axis=0)
@@ -7,6 +7,11 @@ from pathlib import Path
 import numpy as np
 import yaml
 
+from pycdscripts.parallel_input_files import (
+    JOB_ARRAY_MANIFEST_FILE_NAME, get_array_directive, get_job_array_task_lines,
+    write_job_array_manifest)
+from pycdscripts.walltime_estimator import fit_cost_model, predict_run_time
+
 
 class SimulationFiles(object):
     """Class definition to generate simulation files"""
@@ -127,6 +132,14 @@ class SimulationFiles(object):
             run_file_path.chmod(0o755)
 
             if self.run['compute_mode'] == 'parallel':
+                parallel_input_args = ''
+                if self.slurm.get('job_array', False):
+                    parallel_input_args = (", job_array=True, "
+                                           f"array_throttle={self.slurm.get('array_throttle')}")
+                elif self.slurm.get('packed', False):
+                    parallel_input_args = (", packed=True, "
+                                           f"num_tasks={self.slurm['num_tasks_per_node']}")
+
                 # generate simulation preproduction file
                 pre_prod_file_path = work_dir_path.joinpath(self.run['pre_prod_file_name'])
                 with pre_prod_file_path.open('w') as pre_prod_file:
@@ -138,7 +151,7 @@ class SimulationFiles(object):
                         "from pyctscripts.parallel_input_files import generate_parallel_input_files\n\n"
                         "cwd = Path.cwd()\n"
                         "material_preprod(cwd)\n"
-                        "generate_parallel_input_files(cwd)\n")
+                        f"generate_parallel_input_files(cwd{parallel_input_args})\n")
                 pre_prod_file_path.chmod(0o755)
 
                 # generate slurmscript file to compute MSD
@@ -196,12 +209,129 @@ class SimulationFiles(object):
                            + (self.slurm['add_on_time_limit'] * self.HR2SEC))
         return est_run_time
 
+    def slurm_time_limit(self, species_count_list, kmc_prec, cost_model=None):
+        """Returns (days, hours, minutes, seconds) of the slurm time limit.
+        Walltimes of past jobs in cost_model take precedence over the static
+        estimate from run_time"""
+        num_days = num_hours = num_mins = num_sec = 0
+        if self.slurm['partition'] == 'debug':
+            num_hours = 1
+        elif self.slurm['partition'] == 'mdupuis2':
+            num_days = self.slurm['md_slurm_job_max_time_limit']
+        else:
+            est_run_time = None
+            if cost_model is not None:
+                if self.run['compute_mode'] != 'parallel':
+                    num_traj = self.run['n_traj']
+                elif self.slurm.get('packed', False):
+                    # packed jobs run trajectories in waves of tasks-per-node
+                    num_traj = int(np.ceil(self.run['n_traj']
+                                           / self.slurm['num_tasks_per_node']))
+                else:
+                    # each job within a traj directory runs a single trajectory
+                    num_traj = 1
+                est_run_time = predict_run_time(
+                    cost_model, self.system['material'],
+                    self.system['system_size'], species_count_list, num_traj,
+                    self.run['t_final'], self.slurm['walltime_quantile'])
+            if est_run_time is None:
+                est_run_time = self.run_time(species_count_list, kmc_prec)
+            else:
+                est_run_time += int(self.slurm['add_on_time_limit'] * self.HR2SEC)
+            if est_run_time > self.slurm['gc_slurm_job_max_time_limit'] * self.HR2SEC:
+                num_hours = self.slurm['gc_slurm_job_max_time_limit']
+            else:
+                num_hours = est_run_time // self.HR2SEC
+                num_mins = (est_run_time // self.MIN2SEC) % self.MIN2SEC
+            (num_days, num_hours) = divmod(num_hours, 24)
+        return (num_days, num_hours, num_mins, num_sec)
+
+    def write_slurm_directives(self, dst_file, job_name, output_file_name,
+                               time_limit, array_directive=''):
+        dst_file.write('#!/bin/sh\n\n')
+        dst_file.write(f'#SBATCH --job-name="{job_name}"\n')
+        dst_file.write(array_directive)
+        dst_file.write(f'#SBATCH --output={output_file_name}\n')
+        dst_file.write(
+            f"#SBATCH --clusters={self.slurm['clusters']}\n")
+        dst_file.write(
+            f"#SBATCH --partition={self.slurm['partition']}\n")
+        dst_file.write(
+            f"#SBATCH --qos={self.slurm['qos']}\n")
+        dst_file.write(f'#SBATCH --time={time_limit}\n')
+        dst_file.write(f"#SBATCH --nodes={self.slurm['num_nodes']}\n")
+        dst_file.write(f"#SBATCH --tasks-per-node={self.slurm['num_tasks_per_node']}\n")
+        if self.slurm['exclusive']:
+            dst_file.write('#SBATCH --exclusive\n')
+        if self.slurm['mem']:
+            dst_file.write(f"#SBATCH --mem={self.slurm['mem']}\n")
+        if self.slurm['email']:
+            dst_file.write(f"#SBATCH --mail-user={self.slurm['email']}\n")
+            dst_file.write("#SBATCH --mail-type=END\n")
+        dst_file.write(
+            f"#SBATCH --constraint={self.slurm['constraint']}\n")
+        return None
+
+    def write_slurm_body(self, dst_file):
+        dst_file.write(
+            "\n# Job description:\n"
+            "# run KMC simulation followed by performing MSD analysis"
+            " of the output trajectories\n\n"
+            "echo \"SLURM_JOBID=\"$SLURM_JOBID\n"
+            "echo \"SLURM_JOB_NODELIST\"=$SLURM_JOB_NODELIST\n"
+            "echo \"SLURM_NNODES\"=$SLURM_NNODES\n"
+            "echo \"SLURMTMPDIR=\"$SLURMTMPDIR\n\n"
+            "echo \"working directory = \"$SLURM_SUBMIT_DIR\n\n"
+            "HOSTFILE=hosts.$SLURM_JOB_ID\n"
+            "srun hostname -s | sort > $HOSTFILE\n"
+            "module load python/anaconda-4.3.1\n")
+        dst_file.write(f"source activate {self.slurm['conda_env']}\n")
+        dst_file.write(
+            "module list\n"
+            "ulimit -s unlimited\n\n"
+            "# The initial srun will trigger the SLURM prologue on"
+            " the compute nodes.\n"
+            "NPROCS=`srun --nodes=${SLURM_NNODES}"
+            " bash -c 'hostname' |wc -l`\n"
+            "echo NPROCS=$NPROCS\n"
+            "echo \"Launch mymodel with srun\"\n\n"
+            "#The PMI library is necessary for srun\n"
+            "export I_MPI_PMI_LIBRARY=/usr/lib64/libpmi.so\n\n"
+            "SECONDS=0\n")
+        if self.slurm['submit_run']:
+            dst_file.write("srun Run.py\n")
+        if self.slurm['submit_msd']:
+            dst_file.write("srun MSD.py\n")
+        dst_file.write(
+            "\necho \"All Done!\"\n\n"
+            "duration=$SECONDS\n"
+            "days=$((duration/60/60/24))\n"
+            "hours=$((duration/60/60%24))\n"
+            "minutes=$((duration/60%60))\n"
+            "seconds=$((duration%60))\n"
+            "printf 'Time elapsed: '\n"
+            "(( $days > 0 )) && printf '%d days ' $days\n"
+            "(( $hours > 0 )) && printf '%d hours ' $hours\n"
+            "(( $minutes > 0 )) && printf '%d minutes ' $minutes\n"
+            "(( $days > 0 || $hours > 0 || $minutes > 0 )) && printf 'and '\n"
+            "printf '%d seconds\\n' $seconds\n")
+        return None
+
     def slurm_files(self, kmc_prec):
         # keywords
-        job_name_key = ('--job-name="' + self.system['material'] + '-'
+        job_name_key = (self.system['material'] + '-'
                         + 'x'.join(str(element)
                                    for element in self.system['system_size']))
 
+        cost_model = None
+        if self.slurm.get('walltime_quantile') is not None:
+            walltime_scan_path = Path(self.slurm.get('walltime_scan_path',
+                                                     Path.cwd() / 'SimulationFiles'))
+            cost_model = fit_cost_model(walltime_scan_path)
+
+        job_names = []
+        work_dirs = []
+        time_limit_list = []
         for i_run in range(self.num_runs):
             if self.variable_quantity_type_index == 1:
                 self.system['species_count'][self.variable_quantity_index] = self.variable_quantity_list[i_run]
@@ -212,77 +342,43 @@ class SimulationFiles(object):
             (work_dir_path, _) = self.dst_path(species_count_list)
             Path.mkdir(work_dir_path, parents=True, exist_ok=True)
             dst_file_path = work_dir_path.joinpath(self.slurm['dst_file_name'])
+            job_name = (job_name_key
+                        + '_' + self.field_tag.replace(' ', '_')
+                        + '_' + 'e' + str(species_count_list[0])
+                        + 'h' + str(species_count_list[1]))
+            if self.slurm['time']:
+                time_limit = self.slurm['time']
+            else:
+                time_limit_list.append(self.slurm_time_limit(species_count_list, kmc_prec,
+                                                             cost_model))
+                time_limit = '{:02d}-{:02d}:{:02d}:{:02d}'.format(*time_limit_list[-1])
+            job_names.append(job_name)
+            work_dirs.append(work_dir_path.relative_to(Path.cwd()))
 
             # generate slurm file
             with dst_file_path.open('w') as dst_file:
-                dst_file.write('#!/bin/sh\n\n')
-                dst_file.write('#SBATCH ' + job_name_key
-                               + '_' + self.field_tag.replace(' ', '_')
-                               + '_' + 'e' + str(species_count_list[0])
-                               + 'h' + str(species_count_list[1])
-                               + '"\n')
-                dst_file.write('#SBATCH --output=job.out\n')
-                dst_file.write(
-                    f"#SBATCH --clusters={self.slurm['clusters']}\n")
-                dst_file.write(
-                    f"#SBATCH --partition={self.slurm['partition']}\n")
-                dst_file.write(
-                    f"#SBATCH --qos={self.slurm['qos']}\n")
-                if self.slurm['time']:
-                    dst_file.write(f"#SBATCH --time={self.slurm['time']}\n")
-                else:
-                    num_days = num_hours = num_mins = num_sec = 0
-                    if self.slurm['partition'] == 'debug':
-                        num_hours = 1
-                    elif self.slurm['partition'] == 'mdupuis2':
-                        num_days = self.slurm['md_slurm_job_max_time_limit']
-                    else:
-                        est_run_time = self.run_time(species_count_list, kmc_prec)
-                        if est_run_time > self.slurm['gc_slurm_job_max_time_limit']:
-                            num_hours = self.slurm['gc_slurm_job_max_time_limit']
-                        else:
-                            num_hours = est_run_time // self.HR2SEC
-                            num_mins = (est_run_time // self.MIN2SEC) % self.MIN2SEC
-                    time_limit = f'{num_days:02d}-{num_hours:02d}:{num_mins:02d}:{num_sec:02d}'
-                    dst_file.write(f'#SBATCH --time={time_limit}\n')
-                dst_file.write(f"#SBATCH --nodes={self.slurm['num_nodes']}\n")
-                dst_file.write(f"#SBATCH --tasks-per-node={self.slurm['num_tasks_per_node']}\n")
-                if self.slurm['exclusive']:
-                    dst_file.write('#SBATCH --exclusive\n')
-                if self.slurm['mem']:
-                    dst_file.write(f"#SBATCH --mem={self.slurm['mem']}\n")
-                if self.slurm['email']:
-                    dst_file.write(f"#SBATCH --mail-user={self.slurm['email']}\n")
-                    dst_file.write("#SBATCH --mail-type=END\n")
-                dst_file.write(
-                    f"#SBATCH --constraint={self.slurm['constraint']}\n")
-                dst_file.write(
-                    "\n# Job description:\n"
-                    "# run KMC simulation followed by performing MSD analysis"
-                    " of the output trajectories\n\n"
-                    "echo \"SLURM_JOBID=\"$SLURM_JOBID\n"
-                    "echo \"SLURM_JOB_NODELIST\"=$SLURM_JOB_NODELIST\n"
-                    "echo \"SLURM_NNODES\"=$SLURM_NNODES\n"
-                    "echo \"SLURMTMPDIR=\"$SLURMTMPDIR\n\n"
-                    "echo \"working directory = \"$SLURM_SUBMIT_DIR\n\n"
-                    "HOSTFILE=hosts.$SLURM_JOB_ID\n"
-                    "srun hostname -s | sort > $HOSTFILE\n"
-                    "module load python/anaconda-4.3.1\n")
-                dst_file.write(f"source activate {self.slurm['conda_env']}\n")
-                dst_file.write(
-                    "module list\n"
-                    "ulimit -s unlimited\n\n"
-                    "# The initial srun will trigger the SLURM prologue on"
-                    " the compute nodes.\n"
-                    "NPROCS=`srun --nodes=${SLURM_NNODES}"
-                    " bash -c 'hostname' |wc -l`\n"
-                    "echo NPROCS=$NPROCS\n"
-                    "echo \"Launch mymodel with srun\"\n\n"
-                    "#The PMI library is necessary for srun\n"
-                    "export I_MPI_PMI_LIBRARY=/usr/lib64/libpmi.so\n")
-                if self.slurm['submit_run']:
-                    dst_file.write("srun Run.py\n")
-                if self.slurm['submit_msd']:
-                    dst_file.write("srun MSD.py\n")
-                dst_file.write("\necho \"All Done!\"\n")
+                self.write_slurm_directives(dst_file, job_name, 'job.out',
+                                            time_limit)
+                self.write_slurm_body(dst_file)
+
+        # in parallel mode job_array instead spans the traj directories of each run
+        if (self.slurm.get('job_array', False)
+                and self.run['compute_mode'] != 'parallel'):
+            # single array job spanning all runs, each task as long as the longest run
+            if self.slurm['time']:
+                time_limit = self.slurm['time']
+            else:
+                time_limit = '{:02d}-{:02d}:{:02d}:{:02d}'.format(*max(time_limit_list))
+            dst_file_path = Path.cwd().joinpath(f"{self.slurm['dst_file_name']}_array")
+            with dst_file_path.open('w') as dst_file:
+                self.write_slurm_directives(
+                    dst_file, job_name_key, 'job_array_%a.out', time_limit,
+                    get_array_directive(self.num_runs,
+                                        self.slurm.get('array_throttle')))
+                dst_file.write(get_job_array_task_lines())
+                # keep job.out within the working directory of each run
+                dst_file.write('exec > job.out 2>&1\n')
+                self.write_slurm_body(dst_file)
+            write_job_array_manifest(Path.cwd() / JOB_ARRAY_MANIFEST_FILE_NAME,
+                                     job_names, work_dirs)
         return None
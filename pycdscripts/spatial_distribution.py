@@ -2,95 +2,169 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
-from itertools import combinations
-
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import shortest_path
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from matplotlib import cm
 
 from PyCT.io import read_poscar
 
+# memory budget in bytes of the per-chunk temporaries in compute_distance_matrix
+DISTANCE_CHUNK_BYTES = 2**28
+
+
+def compute_distance_matrix(cartesian_coords, system_translational_vector_list,
+                            row_indices, col_indices, return_rel_pos=False,
+                            chunk_bytes=DISTANCE_CHUNK_BYTES):
+    """Returns minimum image distances between all pairs of row and column
+    sites, and optionally the corresponding relative position vectors.
+    Rows are processed in chunks whose temporaries fit within chunk_bytes"""
+    row_indices = np.asarray(row_indices)
+    col_coords = cartesian_coords[col_indices]
+    num_rows = len(row_indices)
+    num_cols = len(col_coords)
+    distance_matrix = np.zeros((num_rows, num_cols))
+    if return_rel_pos:
+        rel_pos_matrix = np.zeros((num_rows, num_cols, 3))
+    # (image, col, xyz) coordinates of all periodic images of column sites
+    col_image_coords = (system_translational_vector_list[:, None, :]
+                        + col_coords[None, :, :])
+    col_range = np.arange(num_cols)
+    # displacement vectors and their norms take 4 floats per (image, col)
+    row_bytes = len(system_translational_vector_list) * num_cols * 4 * 8
+    chunk_size = max(1, chunk_bytes // max(row_bytes, 1))
+    for chunk_start in range(0, num_rows, chunk_size):
+        chunk_indices = row_indices[chunk_start:chunk_start+chunk_size]
+        # (row, image, col, xyz)
+        displacement_vectors = (col_image_coords[None, :, :, :]
+                                - cartesian_coords[chunk_indices, None, None, :])
+        displacements = np.linalg.norm(displacement_vectors, axis=3)
+        min_image_indices = np.argmin(displacements, axis=1)
+        chunk_rows = np.arange(len(chunk_indices))[:, None]
+        chunk_slice = slice(chunk_start, chunk_start + len(chunk_indices))
+        distance_matrix[chunk_slice] = displacements[
+                                chunk_rows, min_image_indices, col_range]
+        if return_rel_pos:
+            rel_pos_matrix[chunk_slice] = displacement_vectors[
+                                chunk_rows, min_image_indices, col_range]
+    if return_rel_pos:
+        return (distance_matrix, rel_pos_matrix)
+    return distance_matrix
+
+def get_system_translational_vector_list(lattice_matrix, fractional_coords):
+    """Returns translation vectors to every periodic image that may host the
+    minimum image of a site with respect to another, for cells of any shape"""
+    # perpendicular widths of the cell along each lattice direction
+    cell_volume = abs(np.linalg.det(lattice_matrix))
+    cell_widths = np.zeros(3)
+    for index in range(3):
+        face_normal = np.cross(lattice_matrix[(index + 1) % 3],
+                               lattice_matrix[(index + 2) % 3])
+        cell_widths[index] = cell_volume / np.linalg.norm(face_normal)
 
-def compute_distance(cartesian_coords, system_translational_vector_list,
-                     index1, index2):
-    center_coord = cartesian_coords[index1]
-    neighbor_coord = cartesian_coords[index2]
-    neighbor_image_coords = (system_translational_vector_list
-                             + neighbor_coord)
-    neighbor_image_displacement_vectors = (neighbor_image_coords
-                                           - center_coord)
-    neighbor_image_displacements = np.linalg.norm(
-                            neighbor_image_displacement_vectors, axis=1)
-    displacement = np.min(neighbor_image_displacements)
-    min_index = np.argmin(neighbor_image_displacements)
-    rel_pos_vector = neighbor_image_displacement_vectors[min_index]
-    return np.append(rel_pos_vector, displacement)
-
-def shell_data(src_path, element_of_interest, dopant_site_number, nn_dist_range):
-    pbc = [1, 1, 1]
-    system_size = np.array([1, 1, 1])  #pseudo
-    poscar_info = read_poscar(src_path)
+    # minimum image distances are bounded by half the longest cell diagonal
+    cutoff = max(np.linalg.norm(np.dot(signs, lattice_matrix))
+                 for signs in ([1, 1, 1], [1, 1, -1], [1, -1, 1], [-1, 1, 1])) / 2
+    # spread of the fractional coordinates within the cell
+    coord_extent = fractional_coords.max(axis=0) - fractional_coords.min(axis=0)
+    max_offsets = np.floor(cutoff / cell_widths + coord_extent).astype(int)
+    min_singular_value = np.linalg.svd(lattice_matrix, compute_uv=False)[-1]
+    image_offsets = []
+    for x_offset in range(-max_offsets[0], max_offsets[0] + 1):
+        for y_offset in range(-max_offsets[1], max_offsets[1] + 1):
+            for z_offset in range(-max_offsets[2], max_offsets[2] + 1):
+                offset = np.array([x_offset, y_offset, z_offset])
+                # lower bound of the separation between any pair of sites
+                # in the cell and the image cell
+                fract_gap = np.maximum(abs(offset) - coord_extent, 0)
+                min_dist = max(np.max(fract_gap * cell_widths),
+                               min_singular_value * np.linalg.norm(fract_gap))
+                if min_dist <= cutoff:
+                    image_offsets.append(offset)
+    return np.dot(np.array(image_offsets), lattice_matrix)
+
+def read_site_geometry(poscar_path):
+    """Returns element data and cartesian site coordinates of a POSCAR file
+    along with translation vectors to its neighboring periodic images"""
+    poscar_info = read_poscar(poscar_path)
     lattice_matrix = poscar_info['lattice_matrix']
-    element_types = poscar_info['element_types']
-    num_elements = poscar_info['num_elements']
     coordinate_type = poscar_info['coordinate_type']
     coords = poscar_info['coordinates']
     if coordinate_type == 'Direct':
         fractional_coords = np.copy(coords)
         cartesian_coords = np.dot(fractional_coords, lattice_matrix)
-    
-    x_range = range(-1, 2) if pbc[0] == 1 else [0]
-    y_range = range(-1, 2) if pbc[1] == 1 else [0]
-    z_range = range(-1, 2) if pbc[2] == 1 else [0]
-    system_translational_vector_list = np.zeros((3**sum(pbc), 3))
-    index = 0
-    for x_offset in x_range:
-        for y_offset in y_range:
-            for z_offset in z_range:
-                system_translational_vector_list[index] = (
-                    np.dot(np.multiply(
-                            np.array([x_offset, y_offset, z_offset]),
-                            system_size), lattice_matrix))
-                index += 1
+    else:
+        cartesian_coords = np.copy(coords)
+        fractional_coords = np.dot(cartesian_coords, np.linalg.inv(lattice_matrix))
+    system_translational_vector_list = get_system_translational_vector_list(
+                                            lattice_matrix, fractional_coords)
+
+    site_geometry = {'lattice_matrix': lattice_matrix,
+                     'element_types': poscar_info['element_types'],
+                     'num_elements': poscar_info['num_elements'],
+                     'cartesian_coords': cartesian_coords,
+                     'system_translational_vector_list':
+                                        system_translational_vector_list}
+    return site_geometry
+
+def compute_dopant_site_distances(site_geometry, element_of_interest,
+                                  dopant_site_numbers, return_rel_pos=False):
+    """Returns minimum image distances from each of the dopant sites to all
+    sites of the element of interest as a (dopant, site) array. With
+    return_rel_pos, returns a (dopant, site, 4) array of relative position
+    vectors followed by distances instead"""
+    element_types = site_geometry['element_types']
+    num_elements = site_geometry['num_elements']
+    site_index_of_interest = element_types.index(element_of_interest)
+    cell_index_prefix = sum(num_elements[:site_index_of_interest])
+    num_sites_of_interest = num_elements[site_index_of_interest]
+    cell_site_indices = cell_index_prefix + np.arange(num_sites_of_interest)
+    dopant_site_indices = cell_index_prefix + np.asarray(dopant_site_numbers) - 1
+    site_distances = compute_distance_matrix(
+                    site_geometry['cartesian_coords'],
+                    site_geometry['system_translational_vector_list'],
+                    dopant_site_indices, cell_site_indices, return_rel_pos)
+    if return_rel_pos:
+        (distance_matrix, rel_pos_matrix) = site_distances
+        return np.concatenate((rel_pos_matrix, distance_matrix[:, :, None]),
+                              axis=2)
+    return site_distances
+
+def shell_data(src_path, element_of_interest, dopant_site_number, nn_dist_range,
+               site_geometry=None):
+    if site_geometry is None:
+        site_geometry = read_site_geometry(src_path)
+    element_types = site_geometry['element_types']
+    num_elements = site_geometry['num_elements']
 
     site_index_of_interest = element_types.index(element_of_interest)
     cell_index_prefix = sum(num_elements[:site_index_of_interest])
     num_sites_of_interest = num_elements[site_index_of_interest]
     dopant_site_index = cell_index_prefix + dopant_site_number - 1
-    cumulative_distance_list = np.zeros((num_sites_of_interest, num_sites_of_interest))
-    for site_index1 in range(num_sites_of_interest):
-        cell_site_index1 = site_index1 + cell_index_prefix
-        for site_index2 in range(num_sites_of_interest):
-            cell_site_index2 = site_index2 + cell_index_prefix
-            cumulative_distance_list[site_index1, site_index2] = compute_distance(
-                            cartesian_coords, system_translational_vector_list,
-                            cell_site_index1, cell_site_index2)[-1]
+    cumulative_distance_list = compute_dopant_site_distances(
+                            site_geometry, element_of_interest,
+                            np.arange(1, num_sites_of_interest + 1))
 
     # (site_index, shell_index, dist_from_site_of_interest)
     distribution_data =  np.zeros((num_sites_of_interest, 3))
     distribution_data[:, 0] = np.arange(num_sites_of_interest)
     distribution_data[:, 2] = cumulative_distance_list[dopant_site_number-1, :]
-    current_shell_index = 0
-    current_shell_site_indices = [dopant_site_number - 1]
-    inner_shell_site_indices = [dopant_site_number - 1]
-    degeneracy_list = [len(inner_shell_site_indices)]
-    while len(np.where(distribution_data[:, 1]==0)[0]) > 1:
-        next_shell_site_indices = []
-        for site_index in current_shell_site_indices:
-            next_shell_site_indices.extend(
-                np.where((cumulative_distance_list[site_index, :] > nn_dist_range[0]) &
-                         (cumulative_distance_list[site_index, :] < nn_dist_range[1]))[0].tolist())
-        next_shell_site_indices = np.unique(next_shell_site_indices).tolist()
-        for site_index in inner_shell_site_indices:
-            if site_index in next_shell_site_indices:
-                next_shell_site_indices.remove(site_index)
-        current_shell_index += 1
-        distribution_data[next_shell_site_indices, 1] = current_shell_index
-        degeneracy_list.append(len(next_shell_site_indices))
-        inner_shell_site_indices.extend(next_shell_site_indices)
-        current_shell_site_indices = next_shell_site_indices[:]
-    num_shells = current_shell_index
+
+    # shell index of a site is its hop count from the dopant site along
+    # nearest neighbor bonds
+    nn_graph = csr_matrix((cumulative_distance_list > nn_dist_range[0])
+                          & (cumulative_distance_list < nn_dist_range[1]))
+    hop_counts = shortest_path(nn_graph, unweighted=True,
+                               indices=dopant_site_number - 1)
+    # sites disconnected from the dopant site are labeled with shell index -1
+    connected_sites = np.isfinite(hop_counts)
+    shell_indices = np.full(num_sites_of_interest, -1, dtype=int)
+    shell_indices[connected_sites] = hop_counts[connected_sites]
+    distribution_data[:, 1] = shell_indices
+    degeneracy_list = np.bincount(shell_indices[connected_sites]).tolist()
+    num_shells = len(degeneracy_list) - 1
     shell_wise_dist_range = np.zeros((num_shells+1, 3))
     shell_wise_dist_range[:, 0] = np.arange(num_shells+1)
     for shell_index in range(num_shells+1):
@@ -104,45 +178,24 @@ def shell_data(src_path, element_of_interest, dopant_site_number, nn_dist_range)
     return shell_data
 
 def penalty_wise_spatial_distribution(system_data_file_name, element_of_interest,
-                                      dopant_site_number):
-    pbc = [1, 1, 1]
-    system_size = np.array([1, 1, 1])  #pseudo
+                                      dopant_site_number, site_geometry=None,
+                                      rel_pos_data=None):
     system_data = np.loadtxt(system_data_file_name)
-    poscar_info = read_poscar('POSCAR')
-    lattice_matrix = poscar_info['lattice_matrix']
-    element_types = poscar_info['element_types']
-    num_elements = poscar_info['num_elements']
-    coordinate_type = poscar_info['coordinate_type']
-    coords = poscar_info['coordinates']
-    if coordinate_type == 'Direct':
-        fractional_coords = np.copy(coords)
-        cartesian_coords = np.dot(fractional_coords, lattice_matrix)
-    
-    x_range = range(-1, 2) if pbc[0] == 1 else [0]
-    y_range = range(-1, 2) if pbc[1] == 1 else [0]
-    z_range = range(-1, 2) if pbc[2] == 1 else [0]
-    system_translational_vector_list = np.zeros((3**sum(pbc), 3))
-    index = 0
-    for x_offset in x_range:
-        for y_offset in y_range:
-            for z_offset in z_range:
-                system_translational_vector_list[index] = (
-                    np.dot(np.multiply(
-                            np.array([x_offset, y_offset, z_offset]),
-                            system_size), lattice_matrix))
-                index += 1
+    if site_geometry is None:
+        site_geometry = read_site_geometry('POSCAR')
+    element_types = site_geometry['element_types']
+    num_elements = site_geometry['num_elements']
 
     site_index_of_interest = element_types.index(element_of_interest)
     num_sites_of_interest = num_elements[site_index_of_interest]
     # (shell index, relpos_x, relpos_y, relpos_z, dist, rel_energy)
     distribution_data = np.zeros((num_sites_of_interest, 6))
     distribution_data[:, 0] = system_data[:, 1]
-    dopant_site_index = sum(num_elements[:site_index_of_interest]) + dopant_site_number - 1
-    for index, site_index in enumerate(range(num_sites_of_interest)):
-        cell_site_index = site_index + sum(num_elements[:site_index_of_interest])
-        distribution_data[index, 1:5] = compute_distance(
-                            cartesian_coords, system_translational_vector_list,
-                            dopant_site_index, cell_site_index)
+    if rel_pos_data is None:
+        rel_pos_data = compute_dopant_site_distances(
+                            site_geometry, element_of_interest,
+                            [dopant_site_number], return_rel_pos=True)[0]
+    distribution_data[:, 1:5] = rel_pos_data
     distribution_data[:, 5] = system_data[:, 3]
 
     plt.switch_backend('Agg')
@@ -191,64 +244,69 @@ def penalty_wise_spatial_distribution(system_data_file_name, element_of_interest
     return None
 
 def three_distant_sites(system_data_file_name, element_of_interest,
-                        dopant_site_number):
-    pbc = [1, 1, 1]
-    system_size = np.array([1, 1, 1])  #pseudo
+                        dopant_site_number, num_top_triplets=20,
+                        block_size=256, site_geometry=None):
     system_data = np.loadtxt(system_data_file_name)
-    poscar_info = read_poscar('POSCAR')
-    lattice_matrix = poscar_info['lattice_matrix']
-    element_types = poscar_info['element_types']
-    num_elements = poscar_info['num_elements']
-    coordinate_type = poscar_info['coordinate_type']
-    coords = poscar_info['coordinates']
-    if coordinate_type == 'Direct':
-        fractional_coords = np.copy(coords)
-        cartesian_coords = np.dot(fractional_coords, lattice_matrix)
-    
-    x_range = range(-1, 2) if pbc[0] == 1 else [0]
-    y_range = range(-1, 2) if pbc[1] == 1 else [0]
-    z_range = range(-1, 2) if pbc[2] == 1 else [0]
-    system_translational_vector_list = np.zeros((3**sum(pbc), 3))
-    index = 0
-    for x_offset in x_range:
-        for y_offset in y_range:
-            for z_offset in z_range:
-                system_translational_vector_list[index] = (
-                    np.dot(np.multiply(
-                            np.array([x_offset, y_offset, z_offset]),
-                            system_size), lattice_matrix))
-                index += 1
+    if site_geometry is None:
+        site_geometry = read_site_geometry('POSCAR')
+    element_types = site_geometry['element_types']
+    num_elements = site_geometry['num_elements']
 
     site_index_of_interest = element_types.index(element_of_interest)
     num_sites_of_interest = num_elements[site_index_of_interest]
-    dopant_site_index = sum(num_elements[:site_index_of_interest]) + dopant_site_number - 1
     available_sites = list(range(sum(num_elements[:site_index_of_interest]), sum(num_elements[:site_index_of_interest]) + num_sites_of_interest))
     available_sites.remove(sum(num_elements[:site_index_of_interest]) + dopant_site_number - 1)
+    available_sites = np.asarray(available_sites)
     num_available_sites = len(available_sites)
-    site_combinations = list(combinations(available_sites, 2))
-    num_combinations = len(site_combinations)
+    available_site_numbers = (available_sites + 1
+                              - sum(num_elements[:site_index_of_interest]))
+    site_distances = compute_dopant_site_distances(
+                            site_geometry, element_of_interest,
+                            np.append(dopant_site_number,
+                                      available_site_numbers))
+    dopant_distances = site_distances[0, available_site_numbers - 1]
+    pair_distances = site_distances[1:, available_site_numbers - 1]
+
+    # site pairs are scored in blocks of rows of the upper triangle, keeping
+    # only the running top num_top_triplets pairs
+    top_pair_indices = np.zeros((0, 2), dtype=int)
     # (d12, d23, d13)
-    dist_array = np.zeros((num_combinations, 3))
-    for index, site_indices in enumerate(site_combinations):
-        dist_array[index, 0] = compute_distance(
-                            cartesian_coords, system_translational_vector_list,
-                            dopant_site_index, site_indices[0])[-1]
-        dist_array[index, 1] = compute_distance(
-                            cartesian_coords, system_translational_vector_list,
-                            site_indices[0], site_indices[1])[-1]
-        dist_array[index, 2] = compute_distance(
-                            cartesian_coords, system_translational_vector_list,
-                            dopant_site_index, site_indices[1])[-1]
-    mean_dist_array = np.mean(dist_array, axis=1)
-    std_dist_array = np.std(dist_array, axis=1)
-    sort_indices = np.argsort(mean_dist_array)[::-1]
-    sorted_site_combinations = np.asarray(site_combinations)[sort_indices]
-    sorted_mean_dist_array = mean_dist_array[sort_indices]
-    sorted_std_dist_array = std_dist_array[sort_indices]
+    top_dist_array = np.zeros((0, 3))
+    for block_start in range(0, num_available_sites, block_size):
+        block_rows = np.arange(block_start,
+                               min(block_start + block_size,
+                                   num_available_sites))
+        (row_indices, col_indices) = np.nonzero(
+                    block_rows[:, None] < np.arange(num_available_sites))
+        row_indices = block_rows[row_indices]
+        pair_indices = np.vstack((top_pair_indices,
+                                  np.column_stack((row_indices, col_indices))))
+        dist_array = np.vstack((top_dist_array, np.column_stack((
+                                    dopant_distances[row_indices],
+                                    pair_distances[row_indices, col_indices],
+                                    dopant_distances[col_indices]))))
+        mean_dist_array = np.mean(dist_array, axis=1)
+        if len(dist_array) > num_top_triplets:
+            kth_index = np.argpartition(-mean_dist_array,
+                                        num_top_triplets - 1)[num_top_triplets - 1]
+            # retain ties at the cutoff so that they are ranked by std below
+            candidate_indices = np.flatnonzero(
+                            mean_dist_array >= mean_dist_array[kth_index])
+        else:
+            candidate_indices = np.arange(len(dist_array))
+        sort_indices = np.lexsort((
+                            np.std(dist_array[candidate_indices], axis=1),
+                            -mean_dist_array[candidate_indices]))
+        top_indices = candidate_indices[sort_indices[:num_top_triplets]]
+        top_pair_indices = pair_indices[top_indices]
+        top_dist_array = dist_array[top_indices]
+    sorted_site_combinations = available_sites[top_pair_indices]
+    sorted_mean_dist_array = np.mean(top_dist_array, axis=1)
+    sorted_std_dist_array = np.std(top_dist_array, axis=1)
     # (site_index2, site_index3, d12, d23, d13, mean_dist, std_dist)
     compiled_array = np.hstack((sorted_site_combinations,
-                                dist_array[sort_indices],
+                                top_dist_array,
                                 sorted_mean_dist_array[:, None],
                                 sorted_std_dist_array[:, None]))
-    print(compiled_array[:20])
+    print(compiled_array)
     return compiled_array
\ No newline at end of file
@@ -2,50 +2,60 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at https://mozilla.org/MPL/2.0/.
 
+from contextlib import nullcontext
+from functools import partial
+from multiprocessing import Pool
+
 import numpy as np
 
+from pycdscripts.segment_map import (get_segment_bin_edges, get_site_segment_map,
+                                     read_gradient_params)
 
-def get_unit_cell_indices(system_size, total_elements_per_unit_cell, n_traj,
-                          occupancy_data):
-    """Returns the unit cell indices of the element
-    :param system_size:
-    :param total_elements_per_unit_cell:
-    :param system_element_index:
-    :return:
+
+def get_site_residence(occupancy, time_data, site_indices):
+    """Returns time-weighted residence and visit counts of every site listed
+    in site_indices, from a single pass over all states
+    :param occupancy:
+    :param time_data:
+    :param site_indices:
+    :return: (site_residence, site_visits):
     """
-    unit_cell_index_data = {}
-    for traj_index in range(n_traj):
-        traj_occupancy_data = occupancy_data[traj_index+1]
-        (num_states, num_species) = traj_occupancy_data.shape
-        traj_unit_cell_indices = np.zeros((num_states, num_species, 3), int)
-        unit_cell_element_indices = traj_occupancy_data % total_elements_per_unit_cell
-        total_filled_unit_cells = ((traj_occupancy_data - unit_cell_element_indices)
-                                   // total_elements_per_unit_cell)
-        for index in range(3):
-            traj_unit_cell_indices[:, :, index] = total_filled_unit_cells / system_size[index+1:].prod()
-            total_filled_unit_cells -= traj_unit_cell_indices[:, :, index] * system_size[index+1:].prod()
-        unit_cell_index_data[traj_index+1] = traj_unit_cell_indices
-    return unit_cell_index_data
+    num_sites = max(np.max(occupancy), np.max(site_indices[:, 0])) + 1
+    weights = np.broadcast_to(time_data, occupancy.shape)
+    site_residence = np.bincount(occupancy.ravel(), weights.ravel(), num_sites)
+    site_visits = np.bincount(occupancy.ravel(), minlength=num_sites)
+    return (site_residence[site_indices[:, 0]], site_visits[site_indices[:, 0]])
 
-def occupancy_analysis(src_path, occupancy, time_data, site_indices):
-    unique_occupancies = np.unique(occupancy)
-    bin_edges = np.hstack((unique_occupancies[0], unique_occupancies[:-1] + np.diff(unique_occupancies) / 2, unique_occupancies[-1]))
-    hist = np.histogram(occupancy, bins=bin_edges, weights=time_data)[0]
-    relative_residence_data = hist / np.sum(hist)
-    num_shells = np.max(site_indices[:, 2])
-    intersection_indices = np.in1d(site_indices[:, 0], unique_occupancies)
-    intersection_site_indices = site_indices[intersection_indices]
-    site_occupancy_data = np.delete(intersection_site_indices, 1, 1)
-    site_occupancy_data = np.hstack((site_occupancy_data, relative_residence_data[:, None]))
+def get_shell_wise_occupancy(site_indices, site_residence, site_visits,
+                             segment_mask):
+    """Returns shell-wise relative residence of visited sites within the
+    segment given by segment_mask
+    :param site_indices:
+    :param site_residence:
+    :param site_visits:
+    :param segment_mask:
+    :return:
+    """
+    num_shells = np.max(site_indices[segment_mask, 2])
+    visited_mask = segment_mask & (site_visits > 0) & (site_indices[:, 2] >= 0)
+    shell_indices = site_indices[visited_mask, 2]
+    relative_residence_data = (site_residence[visited_mask]
+                               / np.sum(site_residence[visited_mask]))
     # (shell_index, mean_relative_residence, min_relative_residence, max_relative_residence)
     shell_wise_occupancy_data = np.zeros((num_shells+1, 4))
     shell_wise_occupancy_data[:, 0] = np.arange(num_shells+1)
-    for shell_index in range(num_shells+1):
-        shell_occupancy_data = site_occupancy_data[np.where(site_occupancy_data[:, 1]==shell_index)[0], 2]
-        if len(shell_occupancy_data) > 0:
-            shell_wise_occupancy_data[shell_index, 1] = np.sum(shell_occupancy_data)
-            shell_wise_occupancy_data[shell_index, 2] = np.min(shell_occupancy_data)
-            shell_wise_occupancy_data[shell_index, 3] = np.max(shell_occupancy_data)
+    occupied_shells = np.bincount(shell_indices, minlength=num_shells+1) > 0
+    shell_wise_occupancy_data[:, 1] = np.bincount(
+                    shell_indices, relative_residence_data, num_shells+1)
+    min_relative_residence = np.full(num_shells+1, np.inf)
+    np.minimum.at(min_relative_residence, shell_indices, relative_residence_data)
+    max_relative_residence = np.full(num_shells+1, -np.inf)
+    np.maximum.at(max_relative_residence, shell_indices, relative_residence_data)
+    shell_wise_occupancy_data[occupied_shells, 2] = min_relative_residence[occupied_shells]
+    shell_wise_occupancy_data[occupied_shells, 3] = max_relative_residence[occupied_shells]
+    return shell_wise_occupancy_data
+
+def print_shell_wise_occupancy(shell_wise_occupancy_data):
     np.set_printoptions(precision=4, suppress=True)
     print('shell_wise_occupancy_data:')
     print(shell_wise_occupancy_data)
@@ -60,39 +70,145 @@ def occupancy_analysis(src_path, occupancy, time_data, site_indices):
     print()
     return None
 
-def get_species_distribution(src_path, system_size, total_elements_per_unit_cell,
-                             n_traj, gradient_ld):
-    occupancy = np.load(src_path / 'occupancy.npy')[()][:-1]
-    time = np.load(src_path / 'time_data.npy')[()]
-    time_data = np.diff(time)[:, None]
-    site_indices = np.load(src_path / 'site_indices.npy')[()]
-    print('full system:')
-    occupancy_analysis(src_path, occupancy, time_data, site_indices)
-    
-    occupancy_data = {1: occupancy}
-    unit_cell_index_data = get_unit_cell_indices(
-            system_size, total_elements_per_unit_cell, n_traj, occupancy_data)
-    gradient_unit_cell_index = unit_cell_index_data[1][:, 0, 0]
-    site_indices_data = {1: site_indices[:, 0][:, None]}
-    site_indices_unit_cell_index_data = get_unit_cell_indices(
-            system_size, total_elements_per_unit_cell, n_traj, site_indices_data)
-    gradient_site_indices_unit_cell_index = site_indices_unit_cell_index_data[1][:, 0, 0]
-    
-    first_segment_indices = np.where(gradient_unit_cell_index < 5)[0]
-    first_segment_occupancy = occupancy[first_segment_indices]
-    first_segment_time_data = time_data[first_segment_indices]
-    gradient_unit_cell_index = unit_cell_index_data[1][:, 0, 0]
-    first_segment_site_indices = site_indices[np.where(gradient_site_indices_unit_cell_index < 5)[0]]
-    print()
-    print('first segment:')
-    occupancy_analysis(src_path, first_segment_occupancy, first_segment_time_data, first_segment_site_indices)
-
-    second_segment_indices = np.where(gradient_unit_cell_index >= 5)[0]
-    second_segment_occupancy = occupancy[second_segment_indices]
-    second_segment_time_data = time_data[second_segment_indices]
-    gradient_unit_cell_index = unit_cell_index_data[1][:, 0, 0]
-    second_segment_site_indices = site_indices[np.where(gradient_site_indices_unit_cell_index >= 5)[0]]
+def occupancy_analysis(src_path, occupancy, time_data, site_indices):
+    (site_residence, site_visits) = get_site_residence(occupancy, time_data,
+                                                       site_indices)
+    segment_mask = np.ones(len(site_indices), bool)
+    print_shell_wise_occupancy(get_shell_wise_occupancy(
+                    site_indices, site_residence, site_visits, segment_mask))
+    return None
+
+def print_traj_shell_wise_occupancy(traj_shell_wise_occupancy_data):
+    np.set_printoptions(precision=4, suppress=True)
+    print('shell_wise_occupancy_data over trajectories: (shell_index, mean, min, max, sem)')
+    print(traj_shell_wise_occupancy_data)
     print()
-    print('second segment:')
-    occupancy_analysis(src_path, second_segment_occupancy, second_segment_time_data, second_segment_site_indices)
+    return None
+
+def get_traj_dir_path(src_path, traj_number, n_traj):
+    """Returns the directory of a trajectory, falling back to src_path for
+    single trajectory runs without traj-level directories
+    :param src_path:
+    :param traj_number:
+    :param n_traj:
+    :return:
+    """
+    traj_dir_path = src_path / f'traj{traj_number}'
+    if traj_dir_path.is_dir():
+        return traj_dir_path
+    if n_traj == 1:
+        return src_path
+    raise FileNotFoundError(f'Trajectory directory {traj_dir_path} not found')
+
+def get_segment_masks(site_indices, site_segment_map, num_segments):
+    """Returns masks of the full system followed by each segment over the
+    rows of site_indices
+    :param site_indices:
+    :param site_segment_map:
+    :param num_segments:
+    :return:
+    """
+    site_segment_indices = site_segment_map[site_indices[:, 0]]
+    # the segment of a state is that of the site its carrier occupies
+    segment_masks = [np.ones(len(site_indices), bool)]
+    segment_masks.extend(site_segment_indices == segment_index
+                         for segment_index in range(num_segments))
+    return segment_masks
+
+def get_traj_shell_wise_occupancy(traj_number, src_path, n_traj,
+                                  site_segment_map, num_segments):
+    """Returns shell-wise occupancy tables of a single trajectory for the full
+    system followed by each segment, with shells taken from the site indices
+    of that trajectory
+    :param traj_number:
+    :param src_path:
+    :param n_traj:
+    :param site_segment_map:
+    :param num_segments:
+    :return:
+    """
+    traj_dir_path = get_traj_dir_path(src_path, traj_number, n_traj)
+    site_indices = np.load(traj_dir_path / 'site_indices.npy')[()]
+    segment_masks = get_segment_masks(site_indices, site_segment_map, num_segments)
+    occupancy = np.load(traj_dir_path / 'occupancy.npy', mmap_mode='r')[:-1]
+    time_data = np.diff(np.load(traj_dir_path / 'time_data.npy'))[:, None]
+    (site_residence, site_visits) = get_site_residence(occupancy, time_data,
+                                                       site_indices)
+    return [get_shell_wise_occupancy(site_indices, site_residence, site_visits,
+                                     segment_mask)
+            for segment_mask in segment_masks]
+
+def get_species_distribution(src_path, system_size, total_elements_per_unit_cell,
+                             n_traj, gradient_ld, step_length_ratio=None,
+                             n_workers=1):
+    if step_length_ratio is None:
+        # segments of the doping gradient in simulation_parameters.yml
+        (_, _, step_length_ratio) = read_gradient_params(src_path)
+    num_segments = len(step_length_ratio)
+    bin_edges = get_segment_bin_edges(system_size, gradient_ld, step_length_ratio)
+    site_segment_map = get_site_segment_map(src_path, system_size, gradient_ld,
+                                            bin_edges,
+                                            total_elements_per_unit_cell)
+    segment_names = ['full system']
+    segment_names.extend(f'segment {segment_index+1}'
+                         for segment_index in range(num_segments))
+
+    traj_occupancy = partial(get_traj_shell_wise_occupancy, src_path=src_path,
+                             n_traj=n_traj, site_segment_map=site_segment_map,
+                             num_segments=num_segments)
+    traj_numbers = range(1, n_traj+1)
+    with (Pool(n_workers) if n_workers > 1 else nullcontext()) as pool:
+        if pool is not None:
+            traj_results = pool.imap(traj_occupancy, traj_numbers)
+        else:
+            traj_results = map(traj_occupancy, traj_numbers)
+
+        # running (sum, squared sum, min, max) of shell-wise relative residence
+        # of each segment over trajectories
+        residence_stats = None
+        for (traj_index, shell_wise_occupancy_list) in enumerate(traj_results):
+            if n_traj == 1:
+                for (segment_index, shell_wise_occupancy_data) in enumerate(
+                                                    shell_wise_occupancy_list):
+                    if segment_index:
+                        print()
+                    print(f'{segment_names[segment_index]}:')
+                    print_shell_wise_occupancy(shell_wise_occupancy_data)
+                continue
+            if residence_stats is None:
+                residence_stats = [np.zeros((4, 0))
+                                   for _ in shell_wise_occupancy_list]
+            for (segment_index, shell_wise_occupancy_data) in enumerate(
+                                                    shell_wise_occupancy_list):
+                # dopant shells differ between trajectories, so shells beyond
+                # those of a trajectory count as unoccupied within it
+                num_shells = max(residence_stats[segment_index].shape[1],
+                                 len(shell_wise_occupancy_data))
+                segment_stats = np.pad(
+                        residence_stats[segment_index],
+                        ((0, 0), (0, num_shells - residence_stats[segment_index].shape[1])))
+                relative_residence = np.zeros(num_shells)
+                relative_residence[:len(shell_wise_occupancy_data)] = shell_wise_occupancy_data[:, 1]
+                if traj_index:
+                    segment_stats[2] = np.minimum(segment_stats[2], relative_residence)
+                    segment_stats[3] = np.maximum(segment_stats[3], relative_residence)
+                else:
+                    segment_stats[2:] = relative_residence
+                segment_stats[0] += relative_residence
+                segment_stats[1] += relative_residence**2
+                residence_stats[segment_index] = segment_stats
+
+    if n_traj > 1:
+        for (segment_index, segment_stats) in enumerate(residence_stats):
+            mean_residence = segment_stats[0] / n_traj
+            var_residence = np.maximum(
+                    segment_stats[1] - n_traj * mean_residence**2, 0) / (n_traj - 1)
+            sem_residence = np.sqrt(var_residence / n_traj)
+            traj_shell_wise_occupancy_data = np.column_stack((
+                    np.arange(len(mean_residence)), mean_residence,
+                    segment_stats[2], segment_stats[3], sem_residence))
+            if segment_index:
+                print()
+            print(f'{segment_names[segment_index]}:')
+            print_traj_shell_wise_occupancy(traj_shell_wise_occupancy_data)
     return None
@@ -10,6 +10,8 @@ t_final="1.00E-02"
 time_interval="1.00E-08"
 n_traj_key="1.00E+02"
 execute_pre_prod=1
+use_job_array=0
+use_packed=0
 submit_slurm_msd=0
 
 for ((j=$start_carriers; j<=$end_carriers; j++))
@@ -19,13 +21,21 @@ do
 	then
 		./pre_prod.py
 	fi
-	for ((i=1; i<=$n_traj; i++))
-	do
-	    cd "traj"$i
-	    sbatch slurmscript | awk -vORS=, '{ print $4 >> "../job_ids.txt" }'
-	    sleep $sleep_time
-	    cd ..
-	done
+	if [ $use_job_array -eq 1 ]
+	then
+		sbatch slurmscript_array | awk -vORS=, '{ print $4 >> "job_ids.txt" }'
+	elif [ $use_packed -eq 1 ]
+	then
+		sbatch slurmscript_packed | awk -vORS=, '{ print $4 >> "job_ids.txt" }'
+	else
+		for ((i=1; i<=$n_traj; i++))
+		do
+		    cd "traj"$i
+		    sbatch slurmscript | awk -vORS=, '{ print $4 >> "../job_ids.txt" }'
+		    sleep $sleep_time
+		    cd ..
+		done
+	fi
 
 	./generate_slurm_msd.py
 	if [ $submit_slurm_msd -eq 1 ]
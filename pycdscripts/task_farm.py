@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+from functools import partial
+import os
+import subprocess
+import time
+
+TASK_FARM_TIMING_FILE_NAME = 'task_farm_timing.txt'
+POLL_INTERVAL = 1.0
+
+
+def get_num_slots(num_tasks=None):
+    """Returns the number of concurrent tasks, defaulting to the tasks per
+    node of the allocation and limited to the cores available to it
+    :param num_tasks:
+    :return:
+    """
+    core_ids = sorted(os.sched_getaffinity(0))
+    if num_tasks is None:
+        num_tasks = int(os.environ.get('SLURM_NTASKS_PER_NODE', len(core_ids)))
+    return min(num_tasks, len(core_ids))
+
+def launch_task(work_dir_path, command, core_id, job_out_file_name):
+    """Starts command within work_dir_path pinned to core_id, appending its
+    output to the job output file
+    :param work_dir_path:
+    :param command:
+    :param core_id:
+    :param job_out_file_name:
+    :return:
+    """
+    job_out_file = open(work_dir_path / job_out_file_name, 'a')
+    try:
+        process = subprocess.Popen(command, cwd=work_dir_path, stdout=job_out_file,
+                                   stderr=subprocess.STDOUT,
+                                   preexec_fn=partial(os.sched_setaffinity, 0, {core_id}))
+    except OSError:
+        job_out_file.close()
+        raise
+    return (process, job_out_file)
+
+def run_task_farm(src_path, work_dirs, command, num_tasks=None,
+                  job_out_file_name='job.out',
+                  timing_file_name=TASK_FARM_TIMING_FILE_NAME):
+    """Runs command within every work dir, keeping up to num_tasks of them
+    running at once with each pinned to its own core. The next work dir is
+    launched as soon as a core frees up and the timing of every finished
+    task is appended to the timing file. Tasks failing to launch count as
+    failed and any tasks still running on exit are terminated
+    :param src_path:
+    :param work_dirs:
+    :param command:
+    :param num_tasks:
+    :param job_out_file_name:
+    :param timing_file_name:
+    :return:
+    """
+    core_ids = sorted(os.sched_getaffinity(0))[:get_num_slots(num_tasks)]
+    pending_work_dirs = list(reversed(work_dirs))
+    free_core_ids = list(reversed(core_ids))
+    running_tasks = {}
+    num_failed_tasks = 0
+    with open(src_path / timing_file_name, 'w') as timing_file:
+        timing_file.write('work_dir\tcore_id\tstart_time\tend_time\telapsed_time\treturn_code\n')
+        try:
+            while pending_work_dirs or running_tasks:
+                while pending_work_dirs and free_core_ids:
+                    work_dir = pending_work_dirs.pop()
+                    core_id = free_core_ids.pop()
+                    start_time = time.time()
+                    try:
+                        (process, job_out_file) = launch_task(src_path / work_dir, command,
+                                                              core_id, job_out_file_name)
+                    except OSError as error:
+                        print(f'Failed to launch {work_dir}: {error}', flush=True)
+                        timing_file.write(f'{work_dir}\t{core_id}\t{start_time:.0f}\t'
+                                          f'{start_time:.0f}\t0\t-1\n')
+                        timing_file.flush()
+                        num_failed_tasks += 1
+                        free_core_ids.append(core_id)
+                        continue
+                    running_tasks[core_id] = (work_dir, process, job_out_file,
+                                              start_time)
+                    print(f'Launched {work_dir} on core {core_id}', flush=True)
+                if not running_tasks:
+                    continue
+                time.sleep(POLL_INTERVAL)
+                for core_id in list(running_tasks):
+                    (work_dir, process, job_out_file, start_time) = running_tasks[core_id]
+                    return_code = process.poll()
+                    if return_code is None:
+                        continue
+                    end_time = time.time()
+                    elapsed_time = int(round(end_time - start_time))
+                    if return_code == 0:
+                        # same line as printed by the slurm scripts for walltime calibration
+                        job_out_file.seek(0, os.SEEK_END)
+                        job_out_file.write(f'Time elapsed: {elapsed_time} seconds\n')
+                    job_out_file.close()
+                    timing_file.write(f'{work_dir}\t{core_id}\t{start_time:.0f}\t'
+                                      f'{end_time:.0f}\t{elapsed_time}\t{return_code}\n')
+                    timing_file.flush()
+                    num_failed_tasks += return_code != 0
+                    del running_tasks[core_id]
+                    free_core_ids.append(core_id)
+        finally:
+            # do not leave trajectories running past the driver when it is interrupted
+            for (work_dir, process, job_out_file, start_time) in running_tasks.values():
+                process.terminate()
+            for (work_dir, process, job_out_file, start_time) in running_tasks.values():
+                process.wait()
+                job_out_file.close()
+    print(f'{len(work_dirs) - num_failed_tasks} of {len(work_dirs)} tasks '
+          f'completed successfully')
+    return num_failed_tasks
@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import re
+
+import numpy as np
+import yaml
+
+TIME_ELAPSED_TERM = 'Time elapsed:'
+TIME_UNIT_SECONDS = {'day': 24 * 60 * 60, 'hour': 60 * 60, 'minute': 60,
+                     'second': 1}
+TIME_ELAPSED_PATTERN = re.compile(r'(\d+)\s+(day|hour|minute|second)s?')
+
+
+def parse_time_elapsed(job_out_file_path):
+    """Returns the walltime in seconds reported by the last "Time elapsed"
+    line of a job output file, or None for incomplete jobs
+    :param job_out_file_path:
+    :return:
+    """
+    time_elapsed = None
+    with open(job_out_file_path, 'r', errors='replace') as job_out_file:
+        for line in job_out_file:
+            if line.startswith(TIME_ELAPSED_TERM):
+                time_elapsed = sum(int(value) * TIME_UNIT_SECONDS[unit]
+                                   for (value, unit)
+                                   in TIME_ELAPSED_PATTERN.findall(line))
+    return time_elapsed
+
+def get_cost_model_key(material, system_size):
+    return (material, tuple(system_size))
+
+def read_job_record(job_out_file_path):
+    """Returns (cost model key, total species count, walltime per trajectory
+    per unit simulated time) of a completed job, or None when the job did not
+    finish, its simulation parameters are incomplete or it is not a per
+    trajectory job of a parallel run
+    :param job_out_file_path:
+    :return:
+    """
+    time_elapsed = parse_time_elapsed(job_out_file_path)
+    sim_param_file_path = job_out_file_path.parent / 'simulation_parameters.yml'
+    if not time_elapsed or not sim_param_file_path.exists():
+        return None
+    with open(sim_param_file_path, 'r') as stream:
+        sim_params = yaml.safe_load(stream) or {}
+    material = sim_params.get('material')
+    system_size = sim_params.get('system_size')
+    species_count = sim_params.get('species_count')
+    n_traj = sim_params.get('n_traj')
+    t_final = sim_params.get('t_final')
+    if (material is None or system_size is None or not species_count
+            or n_traj is None or not t_final):
+        return None
+    # jobs in parallel mode run a single trajectory within each traj directory,
+    # whereas run-level outputs are from MSD or packed jobs and are skipped
+    if sim_params.get('compute_mode') == 'parallel':
+        if not job_out_file_path.parent.name.startswith('traj'):
+            return None
+        num_traj = 1
+    else:
+        num_traj = int(n_traj)
+    num_species = sum(species_count)
+    if not num_traj or not num_species:
+        return None
+    key = get_cost_model_key(material, system_size)
+    return (key, num_species, time_elapsed / (num_traj * float(t_final)))
+
+def fit_cost_model(scan_path, job_out_file_name='job.out'):
+    """Returns a cost model mapping (material, system_size) to the total
+    species counts and walltimes per trajectory per unit simulated time of
+    every completed job found under scan_path
+    :param scan_path:
+    :param job_out_file_name:
+    :return:
+    """
+    cost_model = {}
+    for job_out_file_path in sorted(scan_path.rglob(job_out_file_name)):
+        job_record = read_job_record(job_out_file_path)
+        if job_record is not None:
+            (key, num_species, unit_cost) = job_record
+            cost_model.setdefault(key, []).append((num_species, unit_cost))
+    return {key: tuple(np.asarray(column, dtype=float) for column in zip(*records))
+            for key, records in cost_model.items()}
+
+def predict_run_time(cost_model, material, system_size, species_count, num_traj,
+                     t_final, quantile=0.95):
+    """Returns the walltime in seconds predicted from past jobs with identical
+    material and system size, or None without any past job to calibrate
+    against. The walltime per trajectory per unit simulated time is fit
+    linearly against the total species count, or proportionally to it when
+    past jobs span a single species count, and scaled up to the given
+    quantile of the past jobs relative to the fit
+    :param cost_model:
+    :param material:
+    :param system_size:
+    :param species_count:
+    :param num_traj:
+    :param t_final:
+    :param quantile:
+    :return:
+    """
+    key = get_cost_model_key(material, system_size)
+    if key not in cost_model:
+        return None
+    (species_totals, unit_costs) = cost_model[key]
+    if len(np.unique(species_totals)) > 1:
+        coefficients = np.polyfit(species_totals, unit_costs, 1)
+    else:
+        coefficients = np.array([np.mean(unit_costs / species_totals), 0.])
+    fit_unit_costs = np.polyval(coefficients, species_totals)
+    unit_cost = np.polyval(coefficients, sum(species_count))
+    if unit_cost <= 0 or np.any(fit_unit_costs <= 0):
+        return None
+    unit_cost *= np.quantile(unit_costs / fit_unit_costs, quantile)
+    return int(np.ceil(unit_cost * num_traj * t_final))